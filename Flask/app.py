@@ -63,9 +63,13 @@ logging.basicConfig(filename="log.log", level=logging.WARNING, format=f'%(asctim
 
 app.config['SCHEDULER_API_ENABLED'] = True
 
+app.config['SEARCH_ENGINE'] = 'mongo' # 'mongo' for the $text index or 'memory' for the in-process index
+app.config['SEARCH_SNAPSHOT'] = os.path.join(os.path.dirname(__file__), 'search.snapshot')
+app.config['TAX_SNAPSHOT'] = os.path.join(os.path.dirname(__file__), 'tax.snapshot')
+
 mail = Mail(app)
 
-cors = CORS(app, resources=resources)
+cors = CORS(app, resources=resources, expose_headers=['X-Next-Cursor', 'ETag'])
 api = Api(app, title='Flask API', api_version='1.0', api_spec_url='/api/spec')
 bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
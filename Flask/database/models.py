@@ -10,6 +10,21 @@ from services.util_service import make_ngrams
 
 import base64, os, random, string, datetime
 
+def _refId(ref):
+	'''
+	Get the id of a raw reference (DBRef or Document) without dereferencing it
+	'''
+	return ref.id if ref is not None else None
+
+def _loadAuthors(posts):
+	'''
+	id -> User map of the authors of a list of posts, loaded with a single query
+	'''
+	authorIds = set(filter(None, map(lambda p: _refId(p._data.get('author')), posts)))
+	if not authorIds:
+		return {}
+	return { a.id: a for a in User.objects(id__in=list(authorIds)).only('firstName', 'lastName') }
+
 class Post(db.Document):
 	author = db.ReferenceField('User')
 	title = db.StringField()
@@ -39,17 +54,38 @@ class Post(db.Document):
 
 	def generateNgrams(self):
 		self.titleNgrams = u' '.join(make_ngrams(self.title.lower()))
-		self.titlePrefixNgrams = u' '.join(make_ngrams(self.title.lower(), True))			
-		self.categoriesPrefixNgrams = list(map(lambda c: u' '.join(make_ngrams(c.lower(), True)), self.categories))
+		self.titlePrefixNgrams = u' '.join(make_ngrams(self.title.lower(), prefix_only=True))
+		self.categoriesPrefixNgrams = list(map(lambda c: u' '.join(make_ngrams(c.lower(), prefix_only=True)), self.categories))
+
+	@classmethod
+	def serializeMany(cls, posts):
+		'''
+		Serialize a list of posts, loading all of their authors with a single query
+		'''
+		posts = list(posts)
+		authors = _loadAuthors(posts)
+		return list(map(lambda p: p.serialize(authors), posts))
+
+	def serializeAuthor(self, authors=None):
+		'''
+		authors is an optional id -> User map built by serializeMany
+		'''
+		if authors is None:
+			author = self.author
+		else:
+			author = authors.get(_refId(self._data.get('author')))
+		if author is None:
+			return None
+		return {
+			'id': str(author.id),
+			'firstName': author.firstName,
+			'lastName': author.lastName
+		}
 
-	def serialize(self):
+	def serialize(self, authors=None):
 		return {
 			'id': str(self.id),
-			'author': {
-				'id': str(self.author.id),
-				'firstName': self.author.firstName,
-				'lastName': self.author.lastName
-			},
+			'author': self.serializeAuthor(authors),
 			'title': self.title,
 			'slug': self.slug,
 			'content': self.content,
@@ -67,22 +103,73 @@ class CartItem(db.EmbeddedDocument):
 	product = db.ReferenceField('Product')
 	qty = db.IntField()
 
-	# For orders
+	# For orders, a snapshot of the product when the order was created
 	price = db.DecimalField(precision=2)
-
-	def serialize(self, order=False):
+	title = db.StringField()
+	sku = db.StringField()
+	img = db.ListField(db.StringField())
+	digital = db.BooleanField()
+
+	SNAPSHOT_FIELDS = ('title', 'sku', 'img', 'price', 'digital')
+
+	@classmethod
+	def snapshot(cls, product, qty):
+		'''
+		An order line for the product, loaded with at least SNAPSHOT_FIELDS
+		'''
+		return cls(product=product, qty=qty, price=product.price, title=product.title, sku=product.sku, img=product.img, digital=product.digital)
+
+	@property
+	def productId(self):
+		'''
+		The product id as a string, without dereferencing the product
+		'''
+		productId = _refId(self._data.get('product'))
+		return str(productId) if productId is not None else None
+
+	@classmethod
+	def serializeMany(cls, items):
+		'''
+		Serialize cart lines, loading all of their products with a single projected query.
+		Lines whose product no longer exists are left out
+		'''
+		items = list(items)
+		productIds = set(filter(None, map(lambda i: _refId(i._data.get('product')), items)))
+		products = {}
+		if productIds:
+			products = { p.id: p for p in Product.objects(id__in=list(productIds)).only('title', 'price') }
+		items = filter(lambda i: _refId(i._data.get('product')) in products, items)
+		return list(map(lambda i: i.serialize(products=products), items))
+
+	def serialize(self, order=False, products=None):
 		if order:
+			if self.title is None:
+				# Created before the lines were snapshotted
+				return {
+					'id': str(self.product.id),
+					'product': self.product.serialize(),
+					'qty': self.qty,
+					'price': float(self.price)
+				}
 			return {
-				'id': str(self.product.id),
-				'product': self.product.serialize(),
+				'id': self.productId,
+				'product': {
+					'id': self.productId,
+					'title': self.title,
+					'sku': self.sku,
+					'img': self.img,
+					'price': float(self.price) if self.price is not None else None,
+					'digital': self.digital
+				},
 				'qty': self.qty,
 				'price': float(self.price)
 			}
 		else:
+			product = self.product if products is None else products[_refId(self._data.get('product'))]
 			return {
-				'id': str(self.product.id),
-				'name': self.product.title,
-				'price': float(self.product.price),
+				'id': str(product.id),
+				'name': product.title,
+				'price': float(product.price),
 				'qty': self.qty
 			}
 
@@ -126,7 +213,7 @@ class User(db.Document):
 			'firstName': self.firstName,
 			'lastName': self.lastName,
 
-			'cart': list(map(lambda c: c.serialize(), self.cart))
+			'cart': CartItem.serializeMany(self.cart)
 		}
 
 class Product(Post):
@@ -139,18 +226,30 @@ class Product(Post):
 	totalReviews = db.IntField(default=0)
 	avgReviewScore = db.FloatField(default=0)
 
+	meta = {
+		'indexes': [
+			# ProductsApi filters and sorts: equality fields, then the sort (with id as tie breaker), then the ranges
+			('status', 'id', 'digital', 'price'),
+			('status', 'price', 'id', 'digital'),
+			('status', 'avgReviewScore', 'id', 'digital', 'price'),
+			('status', 'created', 'id', 'digital', 'price'),
+			('status', 'categories', 'id', 'digital', 'price'),
+			('status', 'categories', 'price', 'id', 'digital'),
+			('status', 'categories', 'avgReviewScore', 'id', 'digital', 'price'),
+			('status', 'categories', 'created', 'id', 'digital', 'price'),
+			# In-memory search catch up (products modified since the index was built)
+			'modified'
+		]
+	}
+
 	def addReview(self, score):
 		self.avgReviewScore = ((self.avgReviewScore * self.totalReviews) + int(score)) / (self.totalReviews + 1)
 		self.totalReviews = self.totalReviews + 1
 
-	def serialize(self):
+	def serialize(self, authors=None):
 		return {
 			'id': str(self.id),
-			'author': {
-				'id': str(self.author.id),
-				'firstName': self.author.firstName,
-				'lastName': self.author.lastName
-			},
+			'author': self.serializeAuthor(authors),
 			'title': self.title,
 			'slug': self.slug,
 			'content': self.content,
@@ -168,6 +267,23 @@ class Product(Post):
 			'avgReviewScore': round(self.avgReviewScore, 1) # Round to 1 decimal place
 		}
 
+class OrderTotals(db.EmbeddedDocument):
+	# All in cents
+	subtotal = db.IntField()
+	discount = db.IntField()
+	tax = db.IntField()
+	shipping = db.IntField()
+	total = db.IntField()
+
+	def serialize(self):
+		return {
+			'subtotal': self.subtotal,
+			'discount': self.discount,
+			'tax': self.tax,
+			'shipping': self.shipping,
+			'total': self.total
+		}
+
 class Order(db.Document):
 	orderer = db.ReferenceField('User')
 	orderStatus = db.StringField() # can be 'not placed', 'pending', 'paid', 'shipped', 'completed', 'failed'
@@ -179,6 +295,8 @@ class Order(db.Document):
 	addresses = db.DictField()
 	paymentIntentID = db.StringField()
 	paypalCaptureID = db.StringField()
+	totals = db.EmbeddedDocumentField('OrderTotals')
+	couponsRedeemed = db.BooleanField(default=False)
 	createdAt = db.DateTimeField(default=datetime.datetime.now)
 	modified = db.DateTimeField(default=datetime.datetime.now)
 
@@ -188,12 +306,36 @@ class Order(db.Document):
 		]
 	}
 
-	def serialize(self):
+	@classmethod
+	def serializeMany(cls, orders):
+		'''
+		Serialize a list of orders, loading all of their coupons and the coupon authors with a
+		single query each
+		'''
+		orders = list(orders)
+		couponIds = set()
+		for order in orders:
+			couponIds.update(map(_refId, order._data.get('coupons') or []))
+		coupons = {}
+		if couponIds:
+			coupons = { c.id: c for c in Coupon.objects(id__in=list(couponIds)).exclude('titleNgrams', 'titlePrefixNgrams', 'categoriesPrefixNgrams') }
+		authors = _loadAuthors(coupons.values())
+		return list(map(lambda o: o.serialize(coupons, authors), orders))
+
+	def serialize(self, coupons=None, authors=None):
+		'''
+		coupons and authors are the optional id -> Coupon and id -> User maps built by serializeMany
+		'''
 		mappedProducts = list(map(lambda p: p.serialize(True), self.products))
-		mappedCoupons = list(map(lambda c: c.serialize(), self.coupons))
+		couponIds = list(map(_refId, self._data.get('coupons') or []))
+		if coupons is None:
+			coupons = { c.id: c for c in Coupon.objects(id__in=couponIds).exclude('titleNgrams', 'titlePrefixNgrams', 'categoriesPrefixNgrams') } if couponIds else {}
+		if authors is None:
+			authors = _loadAuthors(list(map(lambda c: coupons[c], filter(lambda c: c in coupons, couponIds))))
+		mappedCoupons = list(map(lambda c: coupons[c].serialize(authors), filter(lambda c: c in coupons, couponIds)))
 		orderer = None
-		if self.orderer:
-			orderer = str(self.orderer.id)
+		if self._data.get('orderer'):
+			orderer = str(_refId(self._data['orderer']))
 		return {
 			'id': str(self.id),
 			'orderer': orderer,
@@ -204,6 +346,7 @@ class Order(db.Document):
 			'shippingType': self.shippingType,
 			'shippingRate': self.shippingRate,
 			'addresses': self.addresses,
+			'totals': self.totals.serialize() if self.totals else None,
 			'createdAt': str(self.createdAt),
 			'modified': str(self.modified)
 		}
@@ -234,14 +377,17 @@ class Coupon(Post):
 	uses = db.IntField(default=0)
 	maxUses = db.IntField(default=-1)
 
-	def serialize(self):
+	@property
+	def applicableProductIds(self):
+		'''
+		The applicable product ids as strings, without dereferencing the products
+		'''
+		return list(map(lambda p: str(_refId(p)), self._data.get('applicableProducts') or []))
+
+	def serialize(self, authors=None):
 		return {
 			'id': str(self.id),
-			'author': {
-				'id': str(self.author.id),
-				'firstName': self.author.firstName,
-				'lastName': self.author.lastName
-			},
+			'author': self.serializeAuthor(authors),
 			'title': self.title,
 			'slug': self.slug,
 			'content': self.content,
@@ -254,7 +400,7 @@ class Coupon(Post):
 			'discountType': self.discountType,
 			'discount': self.discount,
 			'storeWide': self.storeWide,
-			'applicableProducts': list(map(lambda p: str(p.id), self.applicableProducts)),
+			'applicableProducts': self.applicableProductIds,
 			'uses': self.uses,
 			'maxUses': self.maxUses,
 			'created': str(self.created)
@@ -324,4 +470,17 @@ class UsShippingZone(db.Document):
 			'default': self.default
 		}
 
+class RepriceJob(db.Document):
+	status = db.StringField(choices=['queued', 'running', 'done', 'failed'], default='queued')
+	processed = db.IntField(default=0)
+	total = db.IntField()
+	createdAt = db.DateTimeField(default=datetime.datetime.now)
+
+	def serialize(self):
+		return {
+			'status': self.status,
+			'processed': self.processed,
+			'total': self.total
+		}
+
 User.register_delete_rule(Post, 'author', db.CASCADE)
\ No newline at end of file
@@ -12,8 +12,15 @@ from resources.errors import UnauthorizedError, InternalServerError, ResourceNot
 from database.models import User, Page, Product, Order, Coupon, UsShippingZone
 
 from services.logging_service import writeWarningToLog
+from services.pagination_service import paginate, page_response
+from services.fieldset_service import parse_fields, apply_fields, trim_fields
+from services.cache_service import invalidate_product, invalidate_catalog, invalidate_page, invalidate_coupons, invalidate_shipping
+from services.search_service import index_product
+from services.price_service import price_order
+from services.bulk_price_service import start_reprice_job, get_progress, OPEN_STATUSES
+from services.tax_import_service import import_tax_rates
 
-import datetime
+import csv, datetime, io
 
 class AdminApi(Resource):
 	@swagger.doc({
@@ -56,6 +63,22 @@ class AdminUsersApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -70,12 +93,13 @@ class AdminUsersApi(Resource):
 			user = User.objects.get(id=get_jwt_identity())
 			if not user.admin:
 				raise UnauthorizedError
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', User.objects.count()))
-			users = User.objects[page * size : page * size + size]
-			return jsonify(list(map(lambda u: u.serialize(), users)))
+			fields = parse_fields(request.args, User)
+			users, nextCursor = paginate(apply_fields(User.objects, fields), request.args)
+			return page_response(trim_fields(list(map(lambda u: u.serialize(), users)), fields), nextCursor)
 		except UnauthorizedError:
 			raise UnauthorizedError
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.admin.AdminUsersApi get', e)
 			raise InternalServerError
@@ -227,6 +251,22 @@ class AdminPagesApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -241,12 +281,13 @@ class AdminPagesApi(Resource):
 			user = User.objects.get(id=get_jwt_identity())
 			if not user.admin:
 				raise UnauthorizedError
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', Page.objects.count()))
-			pages = Page.objects[page * size : page * size + size]
-			return jsonify(list(map(lambda p: p.serialize(), pages)))
+			fields = parse_fields(request.args, Page)
+			pages, nextCursor = paginate(apply_fields(Page.objects, fields), request.args)
+			return page_response(trim_fields(Page.serializeMany(pages), fields), nextCursor)
 		except UnauthorizedError:
 			raise UnauthorizedError
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.admin.AdminPagesApi get', e)
 			raise InternalServerError
@@ -267,6 +308,7 @@ class AdminPagesApi(Resource):
 				raise UnauthorizedError
 			page = Page(**request.get_json(), author=user)
 			page.save()
+			invalidate_page(page.slug)
 			return jsonify(page.serialize())
 		except UnauthorizedError:
 			raise UnauthorizedError
@@ -335,11 +377,13 @@ class AdminPageApi(Resource):
 			if not user.admin:
 				raise UnauthorizedError
 			page = Page.objects.get(id=id)
+			oldSlug = page.slug
 			page.update(**request.get_json())
 			page.reload()
 			page.modified = datetime.datetime.now
 			page.generateNgrams()
 			page.save()
+			invalidate_page(oldSlug, page.slug)
 			return 'ok'
 		except UnauthorizedError:
 			raise UnauthorizedError
@@ -371,7 +415,9 @@ class AdminPageApi(Resource):
 			user = User.objects.get(id=get_jwt_identity())
 			if not user.admin:
 				raise UnauthorizedError
-			Page.objects.get(id=id).delete()
+			page = Page.objects.get(id=id)
+			page.delete()
+			invalidate_page(page.slug)
 			return 'ok'
 		except UnauthorizedError:
 			raise UnauthorizedError
@@ -448,6 +494,22 @@ class AdminProductsApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -462,12 +524,13 @@ class AdminProductsApi(Resource):
 			user = User.objects.get(id=get_jwt_identity())
 			if not user.admin:
 				raise UnauthorizedError
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', Product.objects.count()))
-			products = Product.objects[page * size : page * size + size]
-			return jsonify(list(map(lambda p: p.serialize(), products)))
+			fields = parse_fields(request.args, Product)
+			products, nextCursor = paginate(apply_fields(Product.objects, fields), request.args)
+			return page_response(trim_fields(Product.serializeMany(products), fields), nextCursor)
 		except UnauthorizedError:
 			raise UnauthorizedError
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.admin.AdminProductsApi get', e)
 			raise InternalServerError
@@ -499,6 +562,9 @@ class AdminProductsApi(Resource):
 			product = Product(**request.get_json(), author=user)
 			product.generateNgrams()
 			product.save()
+			invalidate_product(product.slug)
+			index_product(product)
+			invalidate_catalog()
 			return jsonify(product.serialize())
 		except (FieldDoesNotExist, ValidationError):
 			raise SchemaValidationError
@@ -565,6 +631,7 @@ class AdminProductApi(Resource):
 			if not user.admin:
 				raise UnauthorizedError
 			product = Product.objects.get(id=id)
+			oldSlug = product.slug
 			product.update(**request.get_json())
 			product.reload()
 			if product.price and product.price < 0:
@@ -572,6 +639,9 @@ class AdminProductApi(Resource):
 			product.modified = datetime.datetime.now
 			product.generateNgrams()
 			product.save()
+			invalidate_product(oldSlug, product.slug)
+			index_product(product)
+			invalidate_catalog()
 			return 'ok', 200
 		except InvalidQueryError:
 			raise SchemaValidationError
@@ -606,7 +676,11 @@ class AdminProductApi(Resource):
 				raise UnauthorizedError
 			product = Product.objects.get(id=id)
 			product.status = 'deactivated'
+			product.modified = datetime.datetime.now
 			product.save()
+			invalidate_product(product.slug)
+			index_product(product)
+			invalidate_catalog()
 			return 'ok', 200
 		except UnauthorizedError:
 			raise UnauthorizedError
@@ -691,6 +765,22 @@ class AdminCouponsApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -705,12 +795,13 @@ class AdminCouponsApi(Resource):
 			user = User.objects.get(id=get_jwt_identity())
 			if not user.admin:
 				raise UnauthorizedError
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', Coupon.objects.count()))
-			coupons = Coupon.objects[page * size : page * size + size]
-			return jsonify(list(map(lambda c: c.serialize(), coupons)))
+			fields = parse_fields(request.args, Coupon)
+			coupons, nextCursor = paginate(apply_fields(Coupon.objects, fields), request.args)
+			return page_response(trim_fields(Coupon.serializeMany(coupons), fields), nextCursor)
 		except UnauthorizedError:
 			raise UnauthorizedError
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.admin.AdminCouponsApi get', e)
 			raise InternalServerError
@@ -731,6 +822,7 @@ class AdminCouponsApi(Resource):
 				raise UnauthorizedError
 			coupon = Coupon(**request.get_json(), author=user)
 			coupon.save()
+			invalidate_coupons()
 			return jsonify(coupon.serialize())
 		except (FieldDoesNotExist, ValidationError):
 			raise SchemaValidationError
@@ -805,6 +897,7 @@ class AdminCouponApi(Resource):
 			coupon.modified = datetime.datetime.now
 			coupon.generateNgrams()
 			coupon.save()
+			invalidate_coupons()
 			return 'ok', 200
 		except InvalidQueryError:
 			raise SchemaValidationError
@@ -840,6 +933,7 @@ class AdminCouponApi(Resource):
 			coupon = Coupon.objects.get(id=id)
 			coupon.status = 'deactivated'
 			coupon.save()
+			invalidate_coupons()
 			return 'ok', 200
 		except UnauthorizedError:
 			raise UnauthorizedError
@@ -924,6 +1018,22 @@ class AdminOrdersApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -938,12 +1048,13 @@ class AdminOrdersApi(Resource):
 			user = User.objects.get(id=get_jwt_identity())
 			if not user.admin:
 				raise UnauthorizedError
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', Order.objects.count()))
-			orders = Order.objects[page * size : page * size + size]
-			return jsonify(list(map(lambda o: o.serialize(), orders)))
+			fields = parse_fields(request.args, Order)
+			orders, nextCursor = paginate(apply_fields(Order.objects, fields), request.args)
+			return page_response(trim_fields(Order.serializeMany(orders), fields), nextCursor)
 		except UnauthorizedError:
 			raise UnauthorizedError
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.admin.AdminOrdersApi get', e)
 			raise InternalServerError
@@ -1009,6 +1120,7 @@ class AdminOrderApi(Resource):
 			order.reload()
 			order.modified = datetime.datetime.now
 			order.save()
+			price_order(order)
 			return 'ok', 200
 		except InvalidQueryError:
 			raise SchemaValidationError
@@ -1049,6 +1161,83 @@ class AdminOrderApi(Resource):
 			writeWarningToLog('Unhandled exception in resources.admin.AdminOrderApi delete', e)
 			raise InternalServerError
 
+class AdminOrdersRepriceApi(Resource):
+	@swagger.doc({
+		'tags': ['Admin', 'Order'],
+		'description': 'Start a background job recomputing the totals of every open order',
+		'parameters': [
+			{
+				'name': 'statuses',
+				'description': 'The open order statuses to reprice (not placed by default)',
+				'in': 'body',
+				'type': 'object',
+				'schema': None,
+				'required': False
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The job id'
+			}
+		}
+	})
+	@jwt_required()
+	def post(self):
+		try:
+			user = User.objects.get(id=get_jwt_identity())
+			if not user.admin:
+				raise UnauthorizedError
+			body = request.get_json(silent=True) or {}
+			statuses = body.get('statuses', OPEN_STATUSES)
+			# Only open orders, the totals of placed orders are what the customer paid
+			if not isinstance(statuses, list) or not statuses or not set(statuses) <= set(OPEN_STATUSES):
+				raise SchemaValidationError
+			return jsonify(start_reprice_job(statuses))
+		except (SchemaValidationError, TypeError):
+			raise SchemaValidationError
+		except UnauthorizedError:
+			raise UnauthorizedError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.admin.AdminOrdersRepriceApi post', e)
+			raise InternalServerError
+
+class AdminOrdersRepriceJobApi(Resource):
+	@swagger.doc({
+		'tags': ['Admin', 'Order'],
+		'description': 'Get the progress of a repricing job',
+		'parameters': [
+			{
+				'name': 'id',
+				'description': 'The job id',
+				'in': 'path',
+				'type': 'string',
+				'required': True
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The job status (queued, running, done or failed) and the processed and total order counts'
+			}
+		}
+	})
+	@jwt_required()
+	def get(self, id):
+		try:
+			user = User.objects.get(id=get_jwt_identity())
+			if not user.admin:
+				raise UnauthorizedError
+			progress = get_progress(id)
+			if progress is None:
+				raise ResourceNotFoundError
+			return jsonify(progress)
+		except UnauthorizedError:
+			raise UnauthorizedError
+		except ResourceNotFoundError:
+			raise ResourceNotFoundError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.admin.AdminOrdersRepriceJobApi get', e)
+			raise InternalServerError
+
 class AdminOrderCountApi(Resource):
 	@swagger.doc({
 		'tags': ['Admin', 'Order', 'Counter'],
@@ -1092,6 +1281,22 @@ class AdminUsShippingZonesApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -1106,12 +1311,13 @@ class AdminUsShippingZonesApi(Resource):
 			user = User.objects.get(id=get_jwt_identity())
 			if not user.admin:
 				raise UnauthorizedError
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', Order.objects.count()))
-			shippingZones = UsShippingZone.objects[page * size : page * size + size]
-			return jsonify(list(map(lambda s: s.serialize(), shippingZones)))
+			fields = parse_fields(request.args, UsShippingZone)
+			shippingZones, nextCursor = paginate(apply_fields(UsShippingZone.objects, fields), request.args)
+			return page_response(trim_fields(list(map(lambda s: s.serialize(), shippingZones)), fields), nextCursor)
 		except UnauthorizedError:
 			raise UnauthorizedError
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.admin.AdminUsShippingZonesApi get', e)
 			raise InternalServerError
@@ -1136,6 +1342,7 @@ class AdminUsShippingZonesApi(Resource):
 			except DoesNotExist:
 				zone.default = True
 			zone.save()
+			invalidate_shipping()
 			return jsonify(zone.serialize())
 		except (FieldDoesNotExist, ValidationError):
 			raise SchemaValidationError
@@ -1202,6 +1409,7 @@ class AdminUsShippingZoneApi(Resource):
 			if not user.admin:
 				raise UnauthorizedError
 			UsShippingZone.objects.get(id=id).update(**request.get_json())
+			invalidate_shipping()
 			return 'ok', 200
 		except InvalidQueryError:
 			raise SchemaValidationError
@@ -1235,6 +1443,7 @@ class AdminUsShippingZoneApi(Resource):
 			if not user.admin:
 				raise UnauthorizedError
 			UsShippingZone.objects.get(id=id).delete()
+			invalidate_shipping()
 			return 'ok', 200
 		except UnauthorizedError:
 			raise UnauthorizedError
@@ -1263,4 +1472,42 @@ class AdminUsShippingZoneCountApi(Resource):
 			return UnauthorizedError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.admin.AdminUsShippingZoneCountApi get', e)
+			raise InternalServerError
+
+class AdminTaxImportApi(Resource):
+	@swagger.doc({
+		'tags': ['Admin', 'Tax'],
+		'description': 'Import US tax rate CSVs (one per state) and rebuild the tax table',
+		'parameters': [
+			{
+				'name': 'file',
+				'description': 'The CSV files',
+				'in': 'body',
+				'type': 'file',
+				'schema': None,
+				'required': True
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The number of inserted, updated, unchanged and skipped rows and the changed rates'
+			}
+		}
+	})
+	@jwt_required()
+	def post(self):
+		try:
+			user = User.objects.get(id=get_jwt_identity())
+			if not user.admin:
+				raise UnauthorizedError
+			files = request.files.getlist('file')
+			if not files:
+				raise SchemaValidationError
+			return jsonify(import_tax_rates(map(lambda f: io.TextIOWrapper(f.stream, encoding='utf-8-sig', newline=''), files)))
+		except (SchemaValidationError, UnicodeDecodeError, csv.Error):
+			raise SchemaValidationError
+		except UnauthorizedError:
+			raise UnauthorizedError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.admin.AdminTaxImportApi post', e)
 			raise InternalServerError
\ No newline at end of file
@@ -6,12 +6,21 @@ from flask import jsonify, request
 from flask_restful_swagger_2 import Resource, swagger
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
-from mongoengine.errors import DoesNotExist
-from resources.errors import InternalServerError
+from resources.errors import InternalServerError, SchemaValidationError
+from bson import ObjectId
+from bson.errors import InvalidId
 
-from database.models import User, Product, Coupon
+from database.models import User, Product, CartItem
 
 from services.logging_service import writeWarningToLog
+from services.coupon_service import get_coupon, is_exhausted, applies_to_cart
+from services.quote_service import quote_cart
+
+def parse_qty(qty):
+	qty = int(qty)
+	if qty < 0:
+		raise SchemaValidationError
+	return qty
 
 class CartApi(Resource):
 	'''
@@ -29,9 +38,8 @@ class CartApi(Resource):
 	@jwt_required()
 	def get(self):
 		try:
-			user = User.objects.get(id=get_jwt_identity())
-			products = list(map(lambda p: p.serialize(), user.cart))
-			return jsonify(products)
+			user = User.objects(id=get_jwt_identity()).only('cart').get()
+			return jsonify(CartItem.serializeMany(user.cart))
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.cart.CartApi get', e)
 			raise InternalServerError
@@ -57,22 +65,87 @@ class CartApi(Resource):
 	@jwt_required()
 	def put(self):
 		try:
-			user = User.objects.get(id=get_jwt_identity())
-			pairs = request.get_json()
-			cart = [None] * len(pairs)
-			for i in range(0, len(pairs)):
-				product = Product.objects.get(id=pairs[i]['id'])
-				qty = pairs[i]['qty']
-				cart[i] = {
-					'product': product,
-					'qty': qty
-				}
-			user.update(cart=cart)
-			user.save()
+			# Lines of the same product are merged, empty lines are dropped
+			qtys = {}
+			for pair in request.get_json():
+				productID = ObjectId(pair['id'])
+				qtys[productID] = qtys.get(productID, 0) + parse_qty(pair['qty'])
+			found = set(map(lambda p: p.id, Product.objects(id__in=list(qtys)).only('id')))
+			if len(found) != len(qtys):
+				raise SchemaValidationError
+			cart = list(map(lambda p: CartItem(product=p[0], qty=p[1]), filter(lambda p: p[1] > 0, qtys.items())))
+			User.objects(id=get_jwt_identity()).update_one(set__cart=cart)
 			return 'ok', 200
+		except (SchemaValidationError, InvalidId, KeyError, TypeError, ValueError):
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.cart.CartApi put', e)
 			raise InternalServerError
+	@swagger.doc({
+		'tags': ['Cart'],
+		'description': 'Change a single line of the current user\'s cart',
+		'parameters': [
+			{
+				'name': 'op',
+				'description': 'add (adds qty to the line), set (sets the line qty) or remove',
+				'in': 'body',
+				'type': 'string',
+				'schema': None,
+				'required': True
+			},
+			{
+				'name': 'id',
+				'description': 'The product id',
+				'in': 'body',
+				'type': 'string',
+				'schema': None,
+				'required': True
+			},
+			{
+				'name': 'qty',
+				'description': 'The quantity, not used by remove',
+				'in': 'body',
+				'type': 'int',
+				'schema': None,
+				'required': False
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'Cart updated',
+			}
+		}
+	})
+	@jwt_required()
+	def patch(self):
+		try:
+			body = request.get_json()
+			op = body['op']
+			productID = ObjectId(body['id'])
+			users = User.objects(id=get_jwt_identity())
+			if op == 'remove':
+				users.update_one(pull__cart__product=productID)
+				return 'ok', 200
+			if op not in ('add', 'set'):
+				raise SchemaValidationError
+			qty = parse_qty(body['qty'])
+			if qty == 0:
+				if op == 'set':
+					users.update_one(pull__cart__product=productID)
+				return 'ok', 200
+			if not Product.objects(id=productID).only('id').first():
+				raise SchemaValidationError
+			lineUpdate = { 'inc__cart__S__qty': qty } if op == 'add' else { 'set__cart__S__qty': qty }
+			if not users.filter(cart__product=productID).update_one(**lineUpdate):
+				# Not in the cart yet. The filter keeps a concurrent request from adding the line twice
+				if not users.filter(cart__product__ne=productID).update_one(push__cart=CartItem(product=productID, qty=qty)):
+					users.filter(cart__product=productID).update_one(**lineUpdate)
+			return 'ok', 200
+		except (SchemaValidationError, InvalidId, KeyError, TypeError, ValueError):
+			raise SchemaValidationError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.cart.CartApi patch', e)
+			raise InternalServerError
 
 class CouponCheckApi(Resource):
 	@swagger.doc({
@@ -107,22 +180,66 @@ class CouponCheckApi(Resource):
 			body = request.get_json()
 			code = body.get('code')
 			cart = body.get('cart')
-			coupon = Coupon.objects.get(code=code)
-			if coupon.storeWide:
-				return jsonify(coupon.serialize())
-			if coupon.maxUses != -1 and coupon.maxUses < coupon.uses:
-				return False
-			else:
-				for item in cart:
-					try:
-						product = Product.objects.get(id=item['id'])
-						if product in coupon.applicableProducts:
-							return jsonify(coupon.serialize())
-					except Exception:
-						continue
+			coupon = get_coupon(code)
+			if coupon is None or is_exhausted(coupon):
 				return False
-		except DoesNotExist:
+			if applies_to_cart(coupon, map(lambda item: item.get('id') if isinstance(item, dict) else None, cart or [])):
+				return jsonify(coupon)
 			return False
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.cart.CouponCheckApi post', e)
+			raise InternalServerError
+
+class CartQuoteApi(Resource):
+	@swagger.doc({
+		'tags': ['Cart'],
+		'description': 'Price a cart with coupons, tax and shipping without creating an order',
+		'parameters': [
+			{
+				'name': 'cart',
+				'description': 'An array of CartItem ({ id, qty })',
+				'in': 'body',
+				'type': 'object',
+				'schema': None,
+				'required': True
+			},
+			{
+				'name': 'coupons',
+				'description': 'An array of coupon codes',
+				'in': 'body',
+				'type': 'object',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'zip',
+				'description': 'The shipping ZIP code, for the tax',
+				'in': 'body',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'state',
+				'description': 'The shipping state code, for the shipping rate',
+				'in': 'body',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The lines, the applied and invalid coupons, the tax rate, the shipping rate and the totals in cents'
+			}
+		}
+	})
+	def post(self):
+		try:
+			body = request.get_json()
+			return jsonify(quote_cart(body.get('cart'), body.get('coupons'), body.get('zip'), body.get('state')))
+		except SchemaValidationError:
+			raise SchemaValidationError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.cart.CartQuoteApi post', e)
 			raise InternalServerError
\ No newline at end of file
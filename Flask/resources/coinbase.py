@@ -12,7 +12,9 @@ from coinbase_commerce.webhook import Webhook
 from database.models import Order
 
 from app import socketio
-from services.price_service import calculate_discount_price
+from services.price_service import order_totals
+from services.money_service import format_cents
+from services.coupon_service import redeem_coupons, release_coupons
 
 import json
 
@@ -33,12 +35,7 @@ class CoinbaseCheckoutApi(Resource):
 	def post(self):
 		body = request.get_json()
 		order = Order.objects.get(id=body['orderID'], orderer=get_jwt_identity())
-		amount = calculate_discount_price(order.products, order.coupons)
-		amount += amount * order.taxRate
-		if order.shippingType == 'dollar':
-			amount += order.shippingRate
-		elif order.shippingType == 'percent':
-			amount += amount * order.shippingRate
+		amount = format_cents(order_totals(order).total)
 		charge_info = {
 			'name': 'Test Charge', # TODO: Change this
 			'description': 'Test Description', # TODO: Change this
@@ -52,7 +49,13 @@ class CoinbaseCheckoutApi(Resource):
 				'order': str(order.id)
 			}
 		}
-		charge = ccClient.charge.create(**charge_info)
+		redeemed = redeem_coupons(order.pk)
+		try:
+			charge = ccClient.charge.create(**charge_info)
+		except Exception:
+			if redeemed:
+				release_coupons(order.pk)
+			raise
 		return jsonify({ 'expires_at': charge['expires_at'], 'hosted_url': charge['hosted_url'] })
 
 class CoinbaseApi(Resource):
@@ -74,21 +77,19 @@ class CoinbaseApi(Resource):
 		except (WebhookInvalidPayload, SignatureVerificationError) as e:
 			return str(e), 400
 		
+		# Only the status is written, saving a new Order(id=...) would replace the whole document
+		orderID = event.data.metadata.order
 		if event.type == 'charge:pending':
-			order = Order(id=event.data.metadata.order)
-			order.orderStatus = 'placed'
-			order.save()
+			orderStatus = 'placed'
 		elif event.type == 'charge:confirmed':
-			order = Order(id=event.data.metadata.order)
-			order.orderStatus = 'paid'
-			order.save()
+			orderStatus = 'paid'
 		elif event.type == 'charge:failed':
-			order = Order(id=event.data.metadata.order)
-			order.orderStatus = 'failed'
-			order.save()
+			release_coupons(orderID)
+			orderStatus = 'failed'
 		else:
 			return 'ok', 200
+		Order.objects(id=orderID).update_one(set__orderStatus=orderStatus)
 
-		socketio.emit('order ' + str(order.pk), order.orderStatus)
+		socketio.emit('order ' + str(orderID), orderStatus)
 
 		return 'ok', 200
\ No newline at end of file
@@ -40,6 +40,10 @@ class ResourceNotFoundError(Exception):
 	message = 'Resource Not Found Error'
 	code = '404'
 
+class CouponExhaustedError(Exception):
+	message = 'Coupon Exhausted Error'
+	code = '409'
+
 class MissingOtpError(Exception):
 	message = 'Missing OTP Error'
 	code = '401'
@@ -76,6 +80,10 @@ def handle_(error):
 def handle_(error):
 	return {'message': error.message}, error.code
 
+@app.errorhandler(CouponExhaustedError)
+def handle_(error):
+	return {'message': error.message}, error.code
+
 @app.errorhandler(MissingOtpError)
 def handle_MissingOtpError(error):
 	return {'message': error.message}, error.code
\ No newline at end of file
@@ -9,14 +9,44 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from mongoengine.errors import FieldDoesNotExist, DoesNotExist, ValidationError
 from resources.errors import SchemaValidationError, InternalServerError, UnauthorizedError
 
-from database.models import Order, CartItem, Product, Coupon, UsTaxJurisdiction, UsShippingZone
-from services.price_service import calculate_discount_price
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from database.models import User, Order, CartItem, Product, Coupon, _refId
+from services.price_service import calculate_discount_price, price_order
+from services.shipping_service import get_shipping_zone
+from services.tax_service import get_tax_rate
 from services.logging_service import writeWarningToLog
+from services.fieldset_service import parse_fields, apply_fields, trim_fields
+
+def resolve_items(lines):
+	'''
+	Order lines from (product id, qty) pairs, with every product loaded by one projected query
+	and snapshotted into its line
+	'''
+	ids = list(map(lambda l: l[0], lines))
+	qtys = list(map(lambda l: int(l[1]), lines))
+	if not ids or min(qtys) <= 0:
+		raise SchemaValidationError
+	products = { p.id: p for p in Product.objects(id__in=list(set(ids))).only(*CartItem.SNAPSHOT_FIELDS) }
+	if len(products) != len(set(ids)):
+		raise SchemaValidationError
+	return list(map(lambda l: CartItem.snapshot(products[l[0]], l[1]), zip(ids, qtys)))
 
 class OrdersApi(Resource):
 	@swagger.doc({
 		'tags': ['Order'],
 		'description': 'Get all orders of this user',
+		'parameters': [
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			}
+		],
 		'responses': {
 			'200': {
 				'description': 'Array of Orders',
@@ -26,11 +56,14 @@ class OrdersApi(Resource):
 	@jwt_required()
 	def get(self):
 		try:
-			orders = Order.objects(orderer=get_jwt_identity())
-			mappedOrders = list(map(lambda o: o.serialize(), orders))
-			return jsonify(mappedOrders)
+			fields = parse_fields(request.args, Order)
+			orders = apply_fields(Order.objects(orderer=get_jwt_identity()), fields)
+			mappedOrders = Order.serializeMany(orders)
+			return jsonify(trim_fields(mappedOrders, fields))
 		except DoesNotExist:
 			return jsonify([])
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.order.OrdersApi get', e)
 			raise InternalServerError
@@ -40,11 +73,19 @@ class OrdersApi(Resource):
 		'parameters': [
 			{
 				'name': 'products',
-				'description': 'A list of CartItem',
+				'description': 'A list of CartItem. Not needed with fromCart',
 				'in': 'body',
 				'type': 'object',
 				'schema': None,
-				'required': True
+				'required': False
+			},
+			{
+				'name': 'fromCart',
+				'description': 'Create the order from the stored cart of the signed in user',
+				'in': 'body',
+				'type': 'boolean',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -57,14 +98,19 @@ class OrdersApi(Resource):
 	def post(self):
 		try:
 			body = request.get_json()
-			products = []
-			for p in body['products']:
-				product = Product.objects.get(id=p['id'])
-				products.append(CartItem(product=product, qty=p['qty'], price=product.price))
-			order = Order(orderer=get_jwt_identity(), orderStatus='not placed', products=products)
+			if body.get('fromCart'):
+				if not get_jwt_identity():
+					raise UnauthorizedError
+				cart = User.objects(id=get_jwt_identity()).only('cart').get().cart
+				lines = list(map(lambda i: (_refId(i._data.get('product')), i.qty), cart))
+			else:
+				lines = list(map(lambda p: (ObjectId(p['id']), p['qty']), body['products']))
+			order = Order(orderer=get_jwt_identity(), orderStatus='not placed', products=resolve_items(lines))
 			order.save()
 			return str(order.id), 200
-		except (FieldDoesNotExist, ValidationError, DoesNotExist):
+		except (FieldDoesNotExist, ValidationError, DoesNotExist, InvalidId, KeyError, TypeError, ValueError):
+			raise SchemaValidationError
+		except SchemaValidationError:
 			raise SchemaValidationError
 		except UnauthorizedError:
 			raise UnauthorizedError
@@ -151,33 +197,25 @@ class OrderApi(Resource):
 			body = request.get_json()
 			order = Order.objects.get(id=id, orderer=get_jwt_identity())
 			if (body.get('addresses')):
-				taxJurisdiction = UsTaxJurisdiction.objects.get(zip=str(int(body['addresses']['shipping']['zip'])))
-				shippingZone = None
-				try:
-					shippingZone = UsShippingZone.objects.get(applicableStates=body['addresses']['shipping']['region'])
-				except DoesNotExist:
-					shippingZone = UsShippingZone.objects.get(default=True)
-				rateCandidates = []
-				price = calculate_discount_price(order.products, order.coupons)
-				for rate in shippingZone.rates:
-					if ((rate.minCutoff != None and rate.minCutoff < price) or rate.minCutoff == None) and ((rate.maxCutoff != None and rate.maxCutoff > price) or rate.maxCutoff == None):
-						rateCandidates.append(rate)
-				match = None
-				for candidate in rateCandidates:
-					if match == None:
-						match = candidate
-					else:
-						if match.minCutoff == None and candidate.minCutoff != None:
-							match = candidate
-						elif match.maxCutoff == None and candidate.maxCutoff != None:
-							match = candidate
-						elif match.matchCutoff - match.minCutoff > candidate.maxCutoff - candidate.minCutoff:
-							match = candidate
-				order.update(addresses=body['addresses'], taxRate=taxJurisdiction.estimatedCombinedRate, shippingType=match.type, shippnigRate=match.rate)
+				taxRate = get_tax_rate(body['addresses']['shipping']['zip'])
+				if taxRate is None:
+					raise SchemaValidationError
+				shippingZone = get_shipping_zone(body['addresses']['shipping']['region'])
+				match = shippingZone.select(calculate_discount_price(order.products, order.coupons)) if shippingZone else None
+				if match is None:
+					raise SchemaValidationError
+				order.update(addresses=body['addresses'], taxRate=taxRate, shippingType=match.type, shippingRate=match.rate)
 			if (body.get('coupons')):
+				if order.couponsRedeemed:
+					# The uses of the current coupons are already counted
+					raise SchemaValidationError
 				coupons = list(map(lambda c: Coupon.objects.get(id=c['id']), body['coupons']))
 				order.update(coupons=coupons)
+			order.reload()
+			price_order(order)
 			return 'ok', 200
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.order.OrderApi put', e)
 			raise InternalServerError()
\ No newline at end of file
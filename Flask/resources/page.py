@@ -2,15 +2,19 @@
 Post routes
 '''
 
-from flask import jsonify, request
+from flask import request
 from flask_restful_swagger_2 import Resource, swagger
 
 from mongoengine.errors import DoesNotExist
-from resources.errors import ResourceNotFoundError, InternalServerError
+from resources.errors import ResourceNotFoundError, InternalServerError, SchemaValidationError
 
 from database.models import Page
 
 from services.logging_service import writeWarningToLog
+from services.pagination_service import paginate
+from services.fieldset_service import parse_fields, apply_fields, trim_fields
+from services.cache_service import cached, page_key
+from services.conditional_service import validated, conditional_response
 
 class PagesApi(Resource):
 	@swagger.doc({
@@ -30,6 +34,20 @@ class PagesApi(Resource):
 				'in': 'query',
 				'type': 'int',
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'required': False
 			}
 		],
 		'responses': {
@@ -40,10 +58,11 @@ class PagesApi(Resource):
 	})
 	def get(self):
 		try:
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', 0))
-			pages = Page.objects()[page * size : page * size + size]
-			return jsonify(list(map(lambda p: p.serialize(), pages)))
+			fields = parse_fields(request.args, Page)
+			pages, nextCursor = paginate(apply_fields(Page.objects, fields), request.args)
+			return conditional_response(validated(trim_fields(Page.serializeMany(pages), fields)), nextCursor)
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.page.PagesApi get', e)
 			raise InternalServerError
@@ -69,8 +88,9 @@ class PageApi(Resource):
 	})
 	def get(self):
 		try:
-			page = Page.objects.get(slug=request.args.get('slug'))
-			return jsonify(page.serialize())
+			slug = request.args.get('slug')
+			page = cached(page_key(slug), lambda: validated(Page.objects.get(slug=slug).serialize()))
+			return conditional_response(page)
 		except DoesNotExist:
 			raise ResourceNotFoundError
 		except Exception as e:
@@ -15,7 +15,9 @@ from app import paypal_client
 from paypalcheckoutsdk.orders import OrdersCreateRequest, OrdersCaptureRequest, OrdersGetRequest
 
 from services.logging_service import writeWarningToLog
-from services.price_service import calculate_order_amount, calculate_discount_price
+from services.price_service import order_totals
+from services.money_service import to_cents, format_cents
+from services.coupon_service import redeem_coupons, release_coupons
 
 class PayPalCreateTransactionApi(Resource):
 	@jwt_required(optional=True)
@@ -39,14 +41,7 @@ class PayPalCreateTransactionApi(Resource):
 					"country_code": shipping['country']
 				}
 			}
-			total = calculate_discount_price(order.products, order.coupons)
-			discount = calculate_order_amount(order.products) - total
-			amount = total - discount
-			amount += amount * order.taxRate
-			if order.shippingType == 'dollar':
-				amount += order.shippingRate
-			elif order.shippingType == 'percent':
-				amount += amount * order.shippingRate
+			totals = order_totals(order)
 			requestBody = {
 				"intent": "CAPTURE",
 				"application_context": {
@@ -65,23 +60,23 @@ class PayPalCreateTransactionApi(Resource):
 #						"soft_descriptor": "",
 						"amount": {
 							"currency_code": "USD",
-							"value": '{:.2f}'.format(round(total, 2)),
+							"value": format_cents(totals.total),
 							"breakdown": {
 								"item_total": {
 									"currency_code": "USD",
-									"value": '{:.2f}'.format(round(amount, 2))
+									"value": format_cents(totals.subtotal)
 								},
 								"shipping": {
 									"currency_code": "USD",
-									"value": '{:.2f}'.format(round(0, 2)) # TODO
+									"value": format_cents(totals.shipping)
 								},
 								"tax_total": {
 									"currency_code": "USD",
-									"value": '{:.2f}'.format(round(0, 2)) # TODO
+									"value": format_cents(totals.tax)
 								},
 								"discount": {
 									"currency_code": "USD",
-									"value": '{:.2f}'.format(round(discount, 2))
+									"value": format_cents(totals.discount)
 								}
 							}
 						},
@@ -95,11 +90,7 @@ class PayPalCreateTransactionApi(Resource):
 					"name": item.product.title,
 					"unit_amount": {
 						"currency_code": "USD",
-						"value": str(item.product.price)
-					},
-					"tax": {
-						"currency_code": "USD",
-						"value": 0 # TODO
+						"value": format_cents(to_cents(item.price)) # Price at order time, as in the item_total
 					},
 					"quantity": str(item.qty),
 					"description": item.product.excerpt,
@@ -121,9 +112,15 @@ class PayPalCaptureTransactionApi(Resource):
 	@jwt_required(optional=True)
 	def post(self):
 		orderID = request.get_json()['orderID']
-		response = paypal_client.execute(OrdersCaptureRequest(orderID))
 		orderResponse = paypal_client.execute(OrdersGetRequest(orderID))
 		order = Order.objects.get(id=orderResponse.result.purchase_units[0].custom_id)
+		redeemed = redeem_coupons(order.pk)
+		try:
+			response = paypal_client.execute(OrdersCaptureRequest(orderID))
+		except Exception:
+			if redeemed:
+				release_coupons(order.pk)
+			raise
 		order.paypalCaptureID = response.result.purchase_units[0].payments.captures[0].id
 		order.orderStatus = 'placed'
 		order.save()
@@ -12,11 +12,56 @@ from resources.errors import SchemaValidationError, InternalServerError, Unautho
 from database.models import Product, Review, Order
 
 from services.logging_service import writeWarningToLog
+from services.pagination_service import paginate, page_response, get_page_size
+from services.fieldset_service import parse_fields, apply_fields, trim_fields
+from services.cache_service import cached, list_key, product_key, invalidate_product
+from services.conditional_service import validated, conditional_response
+from services.search_service import search_enabled, search_products, index_product
+from services.autocomplete_service import autocomplete
+
+import datetime
+
+NGRAM_FIELDS = ('titleNgrams', 'titlePrefixNgrams', 'categoriesPrefixNgrams')
+DEFAULT_PRICE_BOUNDARIES = [0, 10, 25, 50, 100, 250, 500, 1000]
+
+PRODUCT_SORTS = {
+	'id': 'id',
+	'price': 'price',
+	'rating': 'avgReviewScore',
+	'created': 'created'
+}
+
+def filter_products(args):
+	'''
+	Product queryset for the filter query parameters. Every combination is served by an index declared in Product.meta
+	'''
+	query = { 'status': 'publish' } # the public catalog never lists unpublished products
+	categories = args.getlist('category')
+	if categories:
+		query['categories__in'] = categories
+	if args.get('digital'):
+		query['digital'] = args['digital'] == 'true'
+	if args.get('minPrice'):
+		query['price__gte'] = float(args['minPrice'])
+	if args.get('maxPrice'):
+		query['price__lte'] = float(args['maxPrice'])
+	return Product.objects(**query)
+
+def product_sort(args):
+	'''
+	The sort field and direction, 'price' is ascending and '-price' descending
+	'''
+	sort = args.get('sort', 'id')
+	descending = sort.startswith('-')
+	key = PRODUCT_SORTS.get(sort.lstrip('-'))
+	if key is None:
+		raise SchemaValidationError
+	return key, descending
 
 class ProductsApi(Resource):
 	@swagger.doc({
 		'tags': ['Product'],
-		'description': 'Get all pages according to pagination criteria',
+		'description': 'Get the products matching the filters according to pagination criteria',
 		'parameters': [
 			{
 				'name': 'page',
@@ -33,6 +78,62 @@ class ProductsApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'category',
+				'description': 'Only return products in this category. Can be repeated to match any of them',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'digital',
+				'description': 'true to only return digital products, false for physical ones',
+				'in': 'query',
+				'type': 'boolean',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'minPrice',
+				'description': 'The minimum price',
+				'in': 'query',
+				'type': 'number',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'maxPrice',
+				'description': 'The maximum price',
+				'in': 'query',
+				'type': 'number',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'sort',
+				'description': 'One of id, price, rating or created. Prefix with - to sort descending',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -43,12 +144,18 @@ class ProductsApi(Resource):
 	})
 	def get(self):
 		try:
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', Product.objects.count()))
-			products = Product.objects[page * size : page * size + size]
-			return jsonify(list(map(lambda p: p.serialize(), products)))
+			def load():
+				fields = parse_fields(request.args, Product)
+				key, descending = product_sort(request.args)
+				products = apply_fields(filter_products(request.args), fields + [key] if fields else None)
+				products, nextCursor = paginate(products, request.args, key, descending)
+				return dict(validated(trim_fields(Product.serializeMany(products), fields)), next=nextCursor)
+			products = cached(list_key('products', request.args), load)
+			return conditional_response(products, products['next'])
 		except UnauthorizedError:
 			raise UnauthorizedError
+		except (SchemaValidationError, ValueError):
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.product.ProductsApi get', e)
 			raise InternalServerError
@@ -74,14 +181,190 @@ class ProductApi(Resource):
 	})
 	def get(self):
 		try:
-			product = Product.objects.get(slug=request.args.get('slug'))
-			return jsonify(product.serialize())
+			slug = request.args.get('slug')
+			product = cached(product_key(slug), lambda: validated(Product.objects.get(slug=slug).serialize()))
+			return conditional_response(product)
 		except DoesNotExist:
 			raise ResourceNotFoundError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.product.ProductApi get', e)
 			raise InternalServerError
 
+class ProductSearchApi(Resource):
+	@swagger.doc({
+		'tags': ['Product', 'Search'],
+		'description': 'Search the published products by title and category, best matches first',
+		'parameters': [
+			{
+				'name': 'q',
+				'description': 'The search terms',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': True
+			},
+			{
+				'name': 'page',
+				'description': 'The page index',
+				'in': 'query',
+				'type': 'int',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'size',
+				'description': 'The page size',
+				'in': 'query',
+				'type': 'int',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'fields',
+				'description': 'Comma separated list of the fields to return',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'An array of Product'
+			}
+		}
+	})
+	def get(self):
+		try:
+			q = request.args.get('q', '').strip().lower()
+			if not q:
+				raise SchemaValidationError
+			def load():
+				fields = parse_fields(request.args, Product)
+				page = int(request.args.get('page', 0))
+				size = get_page_size(request.args)
+				if page < 0:
+					raise SchemaValidationError
+				if search_enabled():
+					ids = search_products(q, page, size)
+					products = Product.objects(id__in=ids)
+				else:
+					products = Product.objects(status='publish').search_text(q).order_by('$text_score')
+				if fields is None:
+					products = products.exclude(*NGRAM_FIELDS)
+				else:
+					products = apply_fields(products, fields)
+				if search_enabled():
+					byId = { str(p.id): p for p in products }
+					products = [byId[id] for id in ids if id in byId]
+				else:
+					products = products[page * size : page * size + size]
+				return validated(trim_fields(Product.serializeMany(products), fields))
+			products = cached('search:' + list_key('products', request.args), load)
+			return conditional_response(products)
+		except (SchemaValidationError, ValueError):
+			raise SchemaValidationError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.product.ProductSearchApi get', e)
+			raise InternalServerError
+
+class ProductAutocompleteApi(Resource):
+	@swagger.doc({
+		'tags': ['Product', 'Search'],
+		'description': 'Get the most popular published products and the categories starting with the typed prefix',
+		'parameters': [
+			{
+				'name': 'q',
+				'description': 'The typed prefix',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': True
+			},
+			{
+				'name': 'limit',
+				'description': 'The maximum number of suggestions of each kind',
+				'in': 'query',
+				'type': 'int',
+				'schema': None,
+				'required': False
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The product (id, title, slug) and category suggestions'
+			}
+		}
+	})
+	def get(self):
+		try:
+			limit = int(request.args.get('limit', 10))
+			return jsonify(autocomplete(request.args.get('q', ''), limit))
+		except ValueError:
+			raise SchemaValidationError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.product.ProductAutocompleteApi get', e)
+			raise InternalServerError
+
+class ProductFacetsApi(Resource):
+	@swagger.doc({
+		'tags': ['Product'],
+		'description': 'Get the number of published products per category and per price range',
+		'parameters': [
+			{
+				'name': 'prices',
+				'description': 'Comma separated, increasing price range boundaries. The last range is open ended',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The category counts and the price histogram'
+			}
+		}
+	})
+	def get(self):
+		try:
+			boundaries = DEFAULT_PRICE_BOUNDARIES
+			if request.args.get('prices'):
+				boundaries = list(map(float, request.args['prices'].split(',')))
+			if len(boundaries) < 2 or boundaries != sorted(set(boundaries)):
+				raise SchemaValidationError
+			def load():
+				pipeline = [
+					{ '$facet': {
+						'categories': [
+							{ '$unwind': '$categories' },
+							{ '$sortByCount': '$categories' }
+						],
+						'prices': [
+							{ '$match': { 'price': { '$gte': boundaries[0] } } },
+							{ '$bucket': {
+								'groupBy': '$price',
+								'boundaries': boundaries,
+								'default': boundaries[-1],
+								'output': { 'count': { '$sum': 1 } }
+							} }
+						]
+					} }
+				]
+				facets = next(Product.objects(status='publish').aggregate(pipeline))
+				upperBounds = dict(zip(boundaries, boundaries[1:]))
+				return validated({
+					'categories': list(map(lambda c: { 'category': c['_id'], 'count': c['count'] }, facets['categories'])),
+					'prices': list(map(lambda p: { 'min': p['_id'], 'max': upperBounds.get(p['_id']), 'count': p['count'] }, facets['prices']))
+				})
+			facets = cached('facets:' + list_key('products', request.args), load)
+			return conditional_response(facets)
+		except (SchemaValidationError, ValueError):
+			raise SchemaValidationError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.product.ProductFacetsApi get', e)
+			raise InternalServerError
+
 class ProductCountApi(Resource):
 	@swagger.doc({
 		'tags': ['Product', 'Counter'],
@@ -129,6 +412,14 @@ class ProductReviewsApi(Resource):
 				'type': 'int',
 				'schema': None,
 				'required': False
+			},
+			{
+				'name': 'cursor',
+				'description': 'The X-Next-Cursor of the previous page. Pass it empty to start cursor pagination',
+				'in': 'query',
+				'type': 'string',
+				'schema': None,
+				'required': False
 			}
 		],
 		'responses': {
@@ -139,11 +430,10 @@ class ProductReviewsApi(Resource):
 	})
 	def get(self, id):
 		try:
-			reviews = Review.objects(product=id)
-			page = int(request.args.get('page', 0))
-			size = int(request.args.get('size', reviews.count()))
-			reviews = list(map(lambda r: r.serialize(), reviews[page * size : page * size + size]))
-			return jsonify(reviews)
+			reviews, nextCursor = paginate(Review.objects(product=id), request.args)
+			return page_response(list(map(lambda r: r.serialize(), reviews)), nextCursor)
+		except SchemaValidationError:
+			raise SchemaValidationError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.product.ProductReviewsApi get', e)
 	@swagger.doc({
@@ -183,7 +473,10 @@ class ProductReviewsApi(Resource):
 			review.save()
 			product = Product.objects.get(id=id)
 			product.addReview(review.score)
+			product.modified = datetime.datetime.now() # the rating is part of the cached product, Last-Modified must move
 			product.save()
+			invalidate_product(product.slug)
+			index_product(product)
 			return jsonify(review.serialize())
 		except (UnauthorizedError, NotUniqueError):
 			raise UnauthorizedError
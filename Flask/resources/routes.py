@@ -6,18 +6,18 @@ from .auth import SignupApi, LoginApi, ForgotPassword, ResetPassword, TokenRefre
 from .file import UploaderApi, MediaApi, SingleMediaApi
 
 from .page import PagesApi, PageApi
-from .product import ProductsApi, ProductApi, ProductCountApi, ProductReviewsApi, ProductReviewsCountApi, ProductReviewAllowedApi
+from .product import ProductsApi, ProductApi, ProductSearchApi, ProductAutocompleteApi, ProductFacetsApi, ProductCountApi, ProductReviewsApi, ProductReviewsCountApi, ProductReviewAllowedApi
 
 from .order import OrdersApi, OrderApi
-from .cart import CartApi, CouponCheckApi
+from .cart import CartApi, CouponCheckApi, CartQuoteApi
 from .usTaxJurisdiction import UsTaxJurisdictionApi
-from .usShippingZone import UsShippingZoneApi
+from .usShippingZone import UsShippingZoneApi, UsShippingQuoteApi
 
 from .stripe import StripeCheckoutApi, StripeApi
 from .paypal import PayPalCreateTransactionApi, PayPalCaptureTransactionApi, PayPalApi
 from .coinbase import CoinbaseCheckoutApi, CoinbaseApi
 
-from .admin import AdminApi, AdminUsersApi, AdminUserApi, AdminUsersCountApi, AdminPagesApi, AdminPageApi, AdminPagesCountApi, AdminPageSlugApi, AdminProductsApi, AdminProductApi, AdminProductCountApi, AdminProductSlugAvailableApi, AdminCouponsApi, AdminCouponApi, AdminCouponCountApi, AdminCouponSlugAvailableApi, AdminOrdersApi, AdminOrderApi, AdminOrderCountApi,AdminUsShippingZonesApi, AdminUsShippingZoneApi, AdminUsShippingZoneCountApi
+from .admin import AdminApi, AdminUsersApi, AdminUserApi, AdminUsersCountApi, AdminPagesApi, AdminPageApi, AdminPagesCountApi, AdminPageSlugApi, AdminProductsApi, AdminProductApi, AdminProductCountApi, AdminProductSlugAvailableApi, AdminCouponsApi, AdminCouponApi, AdminCouponCountApi, AdminCouponSlugAvailableApi, AdminOrdersApi, AdminOrderApi, AdminOrderCountApi, AdminOrdersRepriceApi, AdminOrdersRepriceJobApi, AdminUsShippingZonesApi, AdminUsShippingZoneApi, AdminUsShippingZoneCountApi, AdminTaxImportApi
 
 import resources.sockets
 
@@ -39,6 +39,9 @@ def initialize_routes(api, base):
 	api.add_resource(PageApi, base + 'page/page')
 	api.add_resource(ProductsApi, base + 'product/products')
 	api.add_resource(ProductApi, base + 'product/product')
+	api.add_resource(ProductSearchApi, base + 'product/search')
+	api.add_resource(ProductAutocompleteApi, base + 'product/autocomplete')
+	api.add_resource(ProductFacetsApi, base + 'product/facets')
 	api.add_resource(ProductCountApi, base + 'product/products/count')
 	api.add_resource(ProductReviewsApi, base + 'product/product/<id>/reviews')
 	api.add_resource(ProductReviewsCountApi, base + 'product/product/<id>/reviews/count')
@@ -48,8 +51,10 @@ def initialize_routes(api, base):
 	api.add_resource(OrderApi, base + 'order/order/<id>')
 	api.add_resource(CartApi, base + 'cart/cart')
 	api.add_resource(CouponCheckApi, base + 'cart/couponCheck')
+	api.add_resource(CartQuoteApi, base + 'cart/quote')
 	api.add_resource(UsTaxJurisdictionApi, base + 'tax/us')
 	api.add_resource(UsShippingZoneApi, base + 'shipping/us')
+	api.add_resource(UsShippingQuoteApi, base + 'shipping/us/quote')
 
 	api.add_resource(StripeCheckoutApi, base + 'payment/stripe/checkout')
 	api.add_resource(StripeApi, base + 'payment/stripe/webhook')
@@ -78,6 +83,9 @@ def initialize_routes(api, base):
 	api.add_resource(AdminOrdersApi, base + 'admin/orders')
 	api.add_resource(AdminOrderApi, base + 'admin/order/<id>')
 	api.add_resource(AdminOrderCountApi, base + 'admin/orders/count')
+	api.add_resource(AdminOrdersRepriceApi, base + 'admin/orders/reprice')
+	api.add_resource(AdminOrdersRepriceJobApi, base + 'admin/orders/reprice/<id>')
 	api.add_resource(AdminUsShippingZonesApi, base + 'admin/usShippingZones')
 	api.add_resource(AdminUsShippingZoneApi, base + 'admin/usShippingZone/<id>')
-	api.add_resource(AdminUsShippingZoneCountApi, base + 'admin/usShippingZones/count')
\ No newline at end of file
+	api.add_resource(AdminUsShippingZoneCountApi, base + 'admin/usShippingZones/count')
+	api.add_resource(AdminTaxImportApi, base + 'admin/tax/import')
\ No newline at end of file
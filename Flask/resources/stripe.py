@@ -7,12 +7,13 @@ from flask_restful_swagger_2 import Resource, swagger
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
 from mongoengine.errors import DoesNotExist
-from resources.errors import InternalServerError, UnauthorizedError
+from resources.errors import InternalServerError, UnauthorizedError, CouponExhaustedError
 
 from database.models import Order, User
 
 from app import socketio
-from services.price_service import calculate_discount_price
+from services.price_service import order_totals
+from services.coupon_service import redeem_coupons, release_coupons
 from services.logging_service import writeWarningToLog
 
 import json
@@ -41,52 +42,54 @@ class StripeCheckoutApi(Resource):
 				'phone': shipping['phoneNumber']
 			}
 			email = body['email']
-			amount = calculate_discount_price(order.products, order.coupons)
-			amount += amount * order.taxRate
-			if order.shippingType == 'dollar':
-				amount += order.shippingRate
-			elif order.shippingType == 'percent':
-				amount += amount * order.shippingRate
-			amount = round(amount * 100) # Convert for stripe
-			intent = None
-			if get_jwt_identity():
-				user = User.objects.get(id=get_jwt_identity())
-				cust = None
-				if user.stripeCustomerID:
-					cust = stripe.Customer.retrieve(user.stripeCustomerID)
+			amount = order_totals(order).total # Stripe takes cents
+			redeemed = redeem_coupons(order.pk)
+			try:
+				intent = None
+				if get_jwt_identity():
+					user = User.objects.get(id=get_jwt_identity())
+					cust = None
+					if user.stripeCustomerID:
+						cust = stripe.Customer.retrieve(user.stripeCustomerID)
+					else:
+						cust = stripe.Customer.create(
+							email=email,
+							shipping=shipping,
+							phone=order.addresses['billing']['phoneNumber'],
+							name=order.addresses['billing']['name']
+						)
+						user.stripeCustomerID = cust['id']
+						user.save()
+					intent = stripe.PaymentIntent.create(
+						amount=amount,
+						currency='usd',
+						customer=cust['id'],
+						confirm=True,
+						payment_method=paymentMethodID,
+						shipping=shipping,
+						metadata={order: str(order.pk)}
+					)
 				else:
-					cust = stripe.Customer.create(
-						email=email,
+					intent = stripe.PaymentIntent.create(
+						amount=amount,
+						currency='usd',
+						confirm=True,
+						payment_method=paymentMethodID,
 						shipping=shipping,
-						phone=order.addresses['billing']['phoneNumber'],
-						name=order.addresses['billing']['name']
+						metadata={order: str(order.pk)}
 					)
-					user.stripeCustomerID = cust['id']
-					user.save()
-				intent = stripe.PaymentIntent.create(
-					amount=amount,
-					currency='usd',
-					customer=cust['id'],
-					confirm=True,
-					payment_method=paymentMethodID,
-					shipping=shipping,
-					metadata={order: str(order.pk)}
-				)
-			else:
-				intent = stripe.PaymentIntent.create(
-					amount=amount,
-					currency='usd',
-					confirm=True,
-					payment_method=paymentMethodID,
-					shipping=shipping,
-					metadata={order: str(order.pk)}
-				)
+			except Exception:
+				if redeemed:
+					release_coupons(order.pk)
+				raise
 			order.paymentIntentID = intent['id']
 			order.orderStatus = 'placed'
 			order.save()
 			return str(order.id)
 		except DoesNotExist:
 			raise UnauthorizedError
+		except CouponExhaustedError:
+			raise CouponExhaustedError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.stripe.CheckoutPaymentApi post', str(e))
 			raise InternalServerError
@@ -112,18 +115,18 @@ class StripeApi(Resource):
 		except ValueError:
 			return '', 400
 
+		# Only the status is written, saving a new Order(id=...) would replace the whole document
 		if event.type == 'payment_intent.succeeded':
 			payment_intent = event.data.object # contains a stripe.PaymentIntent
-			order = Order(id=payment_intent['metadata']['Order object'])
-			order.orderStatus = 'paid'
-			order.save()
-			socketio.emit('order ' + str(order.pk), order.orderStatus, namespace='/')
-		elif event.type == 'payment_intent.failed':
+			orderID = payment_intent['metadata']['Order object']
+			Order.objects(id=orderID).update_one(set__orderStatus='paid')
+			socketio.emit('order ' + str(orderID), 'paid', namespace='/')
+		elif event.type == 'payment_intent.payment_failed':
 			payment_intent = event.data.object # contains a stripe.PaymentIntent
-			order = Order(id=payment_intent['metadata']['Order object'])
-			order.orderStatus = 'failed'
-			order.save()
-			socketio.emit('order ' + str(order.pk), order.orderStatus, namespace='/')
+			orderID = payment_intent['metadata']['Order object']
+			release_coupons(orderID)
+			Order.objects(id=orderID).update_one(set__orderStatus='failed')
+			socketio.emit('order ' + str(orderID), 'failed', namespace='/')
 		elif event.type == 'invoice.paid':
 			# TODO: create order with details
 			pass
@@ -5,13 +5,16 @@ US Shipping Zone routes
 from flask import jsonify, request
 from flask_restful_swagger_2 import Resource, swagger
 
-from mongoengine.errors import DoesNotExist
-from resources.errors import InternalServerError, ResourceNotFoundError
-
-from database.models import UsShippingZone
+from resources.errors import InternalServerError, ResourceNotFoundError, SchemaValidationError
 
+from services.shipping_service import get_shipping_zone, quote_shipping
 from services.logging_service import writeWarningToLog
 
+import math
+
+MAX_SUBTOTALS = 1000
+MAX_SUBTOTAL = 1e12 # dollars, larger amounts overflow the Decimal context of to_cents
+
 class UsShippingZoneApi(Resource):
 	@swagger.doc({
 		'tags': ['Shipping'],
@@ -34,14 +37,72 @@ class UsShippingZoneApi(Resource):
 	})
 	def get(self):
 		try:
-			shippingZone = UsShippingZone.objects.get(applicableStates=request.args['state'])
-			return jsonify(shippingZone.serialize())
-		except DoesNotExist:
-			try:
-				shippingZone = UsShippingZone.objects.get(default=True)
-				return jsonify(shippingZone.serialize())
-			except DoesNotExist:
+			shippingZone = get_shipping_zone(request.args['state'])
+			if shippingZone is None:
 				raise ResourceNotFoundError
+			return jsonify(shippingZone.serialized)
+		except ResourceNotFoundError:
+			raise ResourceNotFoundError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.usShippingZone.UsShippingZoneApi get', e)
+			raise InternalServerError
+
+class UsShippingQuoteApi(Resource):
+	@swagger.doc({
+		'tags': ['Shipping'],
+		'description': 'Get the selected shipping rate and the shipping cost of one or many cart subtotals',
+		'parameters': [
+			{
+				'name': 'state',
+				'description': 'The state code',
+				'in': 'body',
+				'type': 'string',
+				'schema': None,
+				'required': True
+			},
+			{
+				'name': 'subtotal',
+				'description': 'The cart subtotal, in dollars',
+				'in': 'body',
+				'type': 'number',
+				'schema': None,
+				'required': False
+			},
+			{
+				'name': 'subtotals',
+				'description': 'An array of cart subtotals in dollars (at most 1000), instead of subtotal',
+				'in': 'body',
+				'type': 'object',
+				'schema': None,
+				'required': False
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The subtotal, the selected shipping rate (null if none) and the shipping cost in cents, for each subtotal'
+			}
+		}
+	})
+	def post(self):
+		try:
+			body = request.get_json()
+			subtotals = body.get('subtotals')
+			if subtotals is None:
+				subtotals = [body['subtotal']]
+			if not isinstance(subtotals, list) or len(subtotals) > MAX_SUBTOTALS:
+				raise SchemaValidationError
+			subtotals = list(map(float, subtotals))
+			# float() and get_json accept NaN and Infinity
+			if not all(map(lambda s: math.isfinite(s) and 0 <= s <= MAX_SUBTOTAL, subtotals)):
+				raise SchemaValidationError
+			quotes = quote_shipping(str(body['state']).upper(), subtotals)
+			if quotes is None:
+				raise ResourceNotFoundError
+			return jsonify(quotes)
+		except (SchemaValidationError, KeyError, TypeError, ValueError):
+			raise SchemaValidationError
+		except ResourceNotFoundError:
+			raise ResourceNotFoundError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.usShippingZone.UsShippingQuoteApi post', e)
 			raise InternalServerError
\ No newline at end of file
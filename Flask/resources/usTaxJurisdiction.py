@@ -5,13 +5,13 @@ US Tax Jurisdiction routes
 from flask import jsonify, request
 from flask_restful_swagger_2 import Resource, swagger
 
-from mongoengine.errors import DoesNotExist
-from resources.errors import InternalServerError, ResourceNotFoundError
-
-from database.models import UsTaxJurisdiction
+from resources.errors import InternalServerError, ResourceNotFoundError, SchemaValidationError
 
+from services.tax_service import get_tax_jurisdiction, get_tax_jurisdictions
 from services.logging_service import writeWarningToLog
 
+MAX_ZIPS = 1000
+
 class UsTaxJurisdictionApi(Resource):
 	@swagger.doc({
 		'tags': ['Tax'],
@@ -34,10 +34,42 @@ class UsTaxJurisdictionApi(Resource):
 	})
 	def get(self):
 		try:
-			taxJurisdiction = UsTaxJurisdiction.objects.get(zip=str(int(request.args['zip']))) # strip leading 0s if present
-			return jsonify(taxJurisdiction.serialize())
-		except DoesNotExist:
+			taxJurisdiction = get_tax_jurisdiction(request.args['zip'])
+			if taxJurisdiction is None:
+				raise ResourceNotFoundError
+			return jsonify(taxJurisdiction)
+		except ResourceNotFoundError:
 			raise ResourceNotFoundError
 		except Exception as e:
 			writeWarningToLog('Unhandled exception in resources.usTaxJurisdiction.UsTaxJurisdictionAPI get', e)
+			raise InternalServerError
+	@swagger.doc({
+		'tags': ['Tax'],
+		'description': 'Get the tax rates of many ZIPs at once',
+		'parameters': [
+			{
+				'name': 'zips',
+				'description': 'An array of ZIPs (at most 1000)',
+				'in': 'body',
+				'type': 'object',
+				'schema': None,
+				'required': True
+			}
+		],
+		'responses': {
+			'200': {
+				'description': 'The tax rates of each ZIP as given, null for the unknown ones'
+			}
+		}
+	})
+	def post(self):
+		try:
+			zips = request.get_json().get('zips')
+			if not isinstance(zips, list) or len(zips) > MAX_ZIPS:
+				raise SchemaValidationError
+			return jsonify(get_tax_jurisdictions(zips))
+		except SchemaValidationError:
+			raise SchemaValidationError
+		except Exception as e:
+			writeWarningToLog('Unhandled exception in resources.usTaxJurisdiction.UsTaxJurisdictionAPI post', e)
 			raise InternalServerError
\ No newline at end of file
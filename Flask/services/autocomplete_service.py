@@ -0,0 +1,122 @@
+'''
+Product typeahead served from memory
+
+Normalized titles (and every word suffix of them, so "shirt" completes "Blue Shirt") are kept
+in a sorted array. A prefix is a bisect range of it, and the range is ranked by popularity.
+Categories get the same treatment, ranked by the number of products in them.
+
+The index is rebuilt from the published products, with one query, in a background thread the
+first time it is used after an admin product write (tracked with the 'catalog' cache version).
+Reviews do not trigger a rebuild, their effect on the ranking waits for the next one.
+'''
+
+from array import array
+from bisect import bisect_left
+
+from database.models import Product
+from services.cache_service import get_version
+
+import heapq, threading
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+MEMO_RANGE = 2000 # ranges wider than this are only ranked once per prefix
+
+def normalize(text):
+	return ' '.join((text or '').lower().split())
+
+def _top(candidates, popularity, limit):
+	return heapq.nlargest(limit, set(candidates), key=lambda o: popularity[o])
+
+class PrefixIndex:
+	def __init__(self, products):
+		self.products = []
+		popularity = []
+		entries = []
+		categories = {}
+		for product in products:
+			ordinal = len(self.products)
+			self.products.append({
+				'id': str(product.id),
+				'title': product.title,
+				'slug': product.slug
+			})
+			# Total of the review scores, ties go to the shorter title
+			popularity.append(((product.totalReviews or 0) * (product.avgReviewScore or 0), -len(product.title or '')))
+			words = normalize(product.title).split(' ')
+			for i in range(len(words)):
+				entries.append((' '.join(words[i:]), ordinal))
+			for category in product.categories or []:
+				key = normalize(category)
+				if key:
+					count = categories.get(key, (category, 0))[1]
+					categories[key] = (category, count + 1)
+		entries.sort()
+		self.keys = list(map(lambda e: e[0], entries))
+		self.ordinals = array('I', map(lambda e: e[1], entries))
+		self.popularity = popularity
+		self.categoryKeys = sorted(categories)
+		self.categories = list(map(lambda k: categories[k], self.categoryKeys))
+		self._memo = {}
+		self._lock = threading.Lock()
+
+	def _range(self, keys, prefix):
+		return bisect_left(keys, prefix), bisect_left(keys, prefix + '\uffff')
+
+	def complete(self, prefix, limit):
+		prefix = normalize(prefix)
+		if not prefix:
+			return { 'products': [], 'categories': [] }
+		lo, hi = self._range(self.keys, prefix)
+		if hi - lo > MEMO_RANGE:
+			with self._lock:
+				ranked = self._memo.get(prefix)
+				if ranked is None:
+					ranked = self._memo[prefix] = _top(self.ordinals[lo:hi], self.popularity, MAX_LIMIT)
+			ordinals = ranked[:limit]
+		else:
+			ordinals = _top(self.ordinals[lo:hi], self.popularity, limit)
+		lo, hi = self._range(self.categoryKeys, prefix)
+		categories = heapq.nlargest(limit, self.categories[lo:hi], key=lambda c: c[1])
+		return {
+			'products': list(map(lambda o: self.products[o], ordinals)),
+			'categories': list(map(lambda c: c[0], categories))
+		}
+
+_index = None # (catalog version, PrefixIndex)
+_indexLock = threading.Lock()
+_rebuilding = False
+
+def _build():
+	return PrefixIndex(Product.objects(status='publish').only('title', 'slug', 'categories', 'totalReviews', 'avgReviewScore'))
+
+def _rebuild(version):
+	global _index, _rebuilding
+	try:
+		index = _build()
+		with _indexLock:
+			_index = (version, index)
+	finally:
+		with _indexLock:
+			_rebuilding = False
+
+def get_index():
+	'''
+	The current index. Only the very first build blocks, later ones run in the background while
+	the previous index keeps answering
+	'''
+	global _index, _rebuilding
+	version = get_version('catalog')
+	if _index is None:
+		with _indexLock:
+			if _index is None:
+				_index = (version, _build())
+	elif _index[0] != version:
+		with _indexLock:
+			if not _rebuilding and _index[0] != version:
+				_rebuilding = True
+				threading.Thread(target=_rebuild, args=(version,), daemon=True).start()
+	return _index[1]
+
+def autocomplete(q, limit=DEFAULT_LIMIT):
+	return get_index().complete(q, max(1, min(limit, MAX_LIMIT)))
@@ -0,0 +1,210 @@
+'''
+Vectorized repricing of many orders at once
+
+After a coupon or tax change the totals of every open order have to be recomputed. The tax
+rate of each order is looked up again from its shipping ZIP in the tax table, and its shipping
+rate is selected again from the zone of its shipping state for the discounted subtotal. Instead of
+running calculate_totals order by order, a chunk of orders is flattened into NumPy arrays
+(one entry per line: price, qty, order index, product index) and the coupons are applied
+position by position with masks, giving exactly the same cents as price_service.
+
+Jobs run in a background thread and report their progress in a RepriceJob document.
+'''
+
+from threading import Thread
+from pymongo import UpdateOne
+from mongoengine.errors import ValidationError
+
+from app import app
+
+from database.models import Order, Coupon, RepriceJob, _refId
+from services.money_service import to_cents, from_cents
+from services.shipping_service import get_shipping_zone
+from services.tax_service import get_tax_rate
+
+import numpy as np
+
+CHUNK_SIZE = 1000
+OPEN_STATUSES = ['not placed']
+
+def _coupon_columns(orderCoupons, coupons, storeWide, type):
+	'''
+	(orders x positions) matrix of the indices of the matching coupons of each order, -1 for none
+	'''
+	columns = []
+	for couponIds in orderCoupons:
+		columns.append([c for c in couponIds if c in coupons and coupons[c]['storeWide'] == storeWide and coupons[c]['type'] == type])
+	width = max(map(len, columns), default=0)
+	matrix = np.full((len(columns), width), -1, dtype=np.int64)
+	for i, column in enumerate(columns):
+		matrix[i, :len(column)] = list(map(lambda c: coupons[c]['index'], column))
+	return matrix
+
+def _apply_column(amounts, couponIndices, mask, type, dollarCents, percentRates):
+	safe = np.maximum(couponIndices, 0)
+	if type == 'dollar':
+		discount = dollarCents[safe]
+	else:
+		discount = np.floor(amounts * percentRates[safe] + 0.5).astype(np.int64)
+	return np.where(mask, amounts - discount, amounts)
+
+def price_batch(orders, coupons, taxRates=None, selectShipping=None):
+	'''
+	Totals (in cents) of a list of orders. coupons maps every referenced coupon id to the Coupon,
+	taxRates optionally replaces the stored taxRate of each order and selectShipping(order,
+	discounted cents) the stored shipping rate (when it returns a ShippingRate).
+	The (shippingType, shippingRate) used for each order are returned as 'shippingRates'
+	'''
+	couponList = list(coupons.values())
+	couponInfo = {}
+	applicable = set()
+	productIndex = {}
+	for index, coupon in enumerate(couponList):
+		couponInfo[coupon.id] = { 'index': index, 'storeWide': bool(coupon.storeWide), 'type': coupon.discountType }
+		for productId in coupon.applicableProductIds:
+			applicable.add((index, productIndex.setdefault(productId, len(productIndex))))
+	dollarCents = np.array(list(map(lambda c: to_cents(c.discount), couponList)) or [0], dtype=np.int64)
+	percentRates = np.array(list(map(lambda c: (c.discount or 0) / 100.0, couponList)) or [0], dtype=np.float64)
+
+	prices, qtys, lineOrders, lineProducts = [], [], [], []
+	orderCoupons = []
+	for i, order in enumerate(orders):
+		for item in order.products:
+			prices.append(to_cents(item.price))
+			qtys.append(item.qty or 0)
+			lineOrders.append(i)
+			lineProducts.append(productIndex.setdefault(item.productId, len(productIndex)))
+		orderCoupons.append(list(map(_refId, order._data.get('coupons') or [])))
+	count = len(orders)
+	prices = np.array(prices, dtype=np.int64)
+	qtys = np.array(qtys, dtype=np.int64)
+	lineOrders = np.array(lineOrders, dtype=np.int64)
+	lineProducts = np.array(lineProducts, dtype=np.int64)
+	productCount = max(len(productIndex), 1)
+	applicableKeys = np.array(list(map(lambda a: a[0] * productCount + a[1], applicable)), dtype=np.int64)
+
+	subtotals = np.zeros(count, dtype=np.int64)
+	np.add.at(subtotals, lineOrders, prices * qtys)
+
+	# Product coupons, per line, in the same order as CompiledCoupons
+	unitPrices = prices.copy()
+	for type in ['dollar', 'percent']:
+		columns = _coupon_columns(orderCoupons, couponInfo, False, type)
+		for k in range(columns.shape[1]):
+			lineCoupons = columns[lineOrders, k]
+			mask = (lineCoupons >= 0) & np.isin(lineCoupons * productCount + lineProducts, applicableKeys)
+			unitPrices = _apply_column(unitPrices, lineCoupons, mask, type, dollarCents, percentRates)
+	unitPrices = np.maximum(unitPrices, 0)
+	discounted = np.zeros(count, dtype=np.int64)
+	np.add.at(discounted, lineOrders, unitPrices * qtys)
+
+	# Store wide coupons, per order
+	for type in ['dollar', 'percent']:
+		columns = _coupon_columns(orderCoupons, couponInfo, True, type)
+		for k in range(columns.shape[1]):
+			orderCouponsAtK = columns[:, k]
+			discounted = _apply_column(discounted, orderCouponsAtK, orderCouponsAtK >= 0, type, dollarCents, percentRates)
+	discounted = np.maximum(discounted, 0)
+
+	if taxRates is None:
+		taxRates = list(map(lambda o: o.taxRate, orders))
+	taxRates = np.array(list(map(lambda r: r or 0, taxRates)), dtype=np.float64)
+	taxes = np.floor(discounted * taxRates + 0.5).astype(np.int64)
+	selected = list(map(lambda o: (o.shippingType, o.shippingRate), orders))
+	if selectShipping is not None:
+		for i, order in enumerate(orders):
+			match = selectShipping(order, int(discounted[i]))
+			if match is not None:
+				selected[i] = (match.type, match.rate)
+	shippingRates = np.array(list(map(lambda s: s[1] or 0, selected)), dtype=np.float64)
+	isPercent = np.array(list(map(lambda s: s[0] == 'percent', selected)), dtype=bool)
+	dollarShipping = np.array(list(map(lambda s: to_cents(s[1]) if s[0] == 'dollar' else 0, selected)), dtype=np.int64)
+	shipping = np.where(isPercent, np.floor(discounted * shippingRates + 0.5).astype(np.int64), dollarShipping)
+
+	return {
+		'subtotal': subtotals,
+		'discount': subtotals - discounted,
+		'tax': taxes,
+		'shipping': shipping,
+		'total': discounted + taxes + shipping,
+		'shippingRates': selected
+	}
+
+TOTALS = ['subtotal', 'discount', 'tax', 'shipping', 'total']
+
+def _set_progress(jobId, **progress):
+	RepriceJob.objects(id=jobId).update_one(**{ 'set__' + key: value for key, value in progress.items() })
+
+def get_progress(jobId):
+	'''
+	The status and the processed and total order counts of a job, or None if there is no such job
+	'''
+	try:
+		job = RepriceJob.objects(id=jobId).first()
+	except ValidationError:
+		return None
+	return job.serialize() if job else None
+
+def _tax_rate(order):
+	'''
+	The current rate of the shipping ZIP from the tax table, the stored one if there is no ZIP
+	'''
+	zip = ((order.addresses or {}).get('shipping') or {}).get('zip')
+	rate = get_tax_rate(zip) if zip else None
+	return rate if rate is not None else order.taxRate
+
+def _shipping_rate(order, discounted):
+	'''
+	The rate of the zone of the shipping state for the discounted subtotal (in cents), like
+	OrderApi.put, or None to keep the stored one
+	'''
+	region = ((order.addresses or {}).get('shipping') or {}).get('region')
+	zone = get_shipping_zone(region) if region else None
+	return zone.select(from_cents(discounted)) if zone else None
+
+def reprice_orders(jobId, statuses=OPEN_STATUSES, chunkSize=CHUNK_SIZE):
+	orders = Order.objects(orderStatus__in=statuses).only('products', 'coupons', 'taxRate', 'shippingType', 'shippingRate', 'addresses')
+	_set_progress(jobId, status='running', processed=0, total=orders.count())
+	coupons = {}
+	processed = 0
+	lastId = None
+	while True:
+		chunk = orders.order_by('id')
+		if lastId is not None:
+			chunk = chunk.filter(id__gt=lastId)
+		chunk = list(chunk.limit(chunkSize))
+		if not chunk:
+			break
+		missing = set()
+		for order in chunk:
+			missing.update(filter(lambda c: c not in coupons, map(_refId, order._data.get('coupons') or [])))
+		if missing:
+			coupons.update({ c.id: c for c in Coupon.objects(id__in=list(missing)) })
+		taxRates = list(map(_tax_rate, chunk))
+		totals = price_batch(chunk, coupons, taxRates, _shipping_rate)
+		Order._get_collection().bulk_write([
+			UpdateOne({ '_id': order.id }, { '$set': {
+				'taxRate': taxRates[i],
+				'shippingType': totals['shippingRates'][i][0],
+				'shippingRate': totals['shippingRates'][i][1],
+				'totals': { key: int(totals[key][i]) for key in TOTALS }
+			} })
+			for i, order in enumerate(chunk)
+		], ordered=False)
+		processed += len(chunk)
+		lastId = chunk[-1].id
+		_set_progress(jobId, processed=processed)
+	_set_progress(jobId, status='done')
+
+def _run(jobId, statuses):
+	with app.app_context():
+		try:
+			reprice_orders(jobId, statuses)
+		except Exception as e:
+			app.logger.warning('Repricing job ' + jobId + ' failed: ' + str(e))
+			_set_progress(jobId, status='failed')
+
+def start_reprice_job(statuses=OPEN_STATUSES):
+	jobId = str(RepriceJob().save().id)
+	Thread(target=_run, args=(jobId, statuses)).start()
+	return jobId
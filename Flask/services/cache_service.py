@@ -0,0 +1,125 @@
+'''
+Read-through cache for serialized catalog data
+
+The default backend is an in-process LRU with a TTL. A shared backend (Redis, memcached...)
+can be swapped in with set_backend; it only has to provide get, set, delete and incr(key, amount=1).
+Values stored in the cache must be JSON serializable.
+'''
+
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import threading, time
+
+DEFAULT_MAX_SIZE = 2048
+DEFAULT_TTL = 300 # seconds
+
+class MemoryCache:
+	def __init__(self, maxSize=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self._entries = OrderedDict()
+		self._counters = {} # never evicted, the versions must survive the LRU
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+			expires, value = entry
+			if expires < time.monotonic():
+				del self._entries[key]
+				return None
+			self._entries.move_to_end(key)
+			return value
+
+	def set(self, key, value):
+		with self._lock:
+			self._entries[key] = (time.monotonic() + self.ttl, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.maxSize:
+				self._entries.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def incr(self, key, amount=1):
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + amount
+			return self._counters[key]
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._counters.clear()
+
+_backend = MemoryCache()
+
+def set_backend(backend):
+	global _backend
+	_backend = backend
+
+def get_backend():
+	return _backend
+
+def cached(key, loader, backend=None):
+	'''
+	Return the cached value for key, calling loader to fill it on a miss. backend defaults to the
+	shared one; high churn entries (quotes, unknown codes) go to their own bounded MemoryCache so
+	they cannot evict the catalog
+	'''
+	backend = backend or _backend
+	value = backend.get(key)
+	if value is None:
+		value = loader()
+		if value is not None:
+			backend.set(key, value)
+	return value
+
+def get_version(namespace):
+	return _backend.incr('version:' + namespace, 0)
+
+def bump_version(namespace):
+	return _backend.incr('version:' + namespace)
+
+def list_key(namespace, args):
+	'''
+	Key of a cached list response. Bumping the namespace version invalidates every list at once
+	'''
+	return '{}:{}:{}'.format(namespace, get_version(namespace), urlencode(sorted(args.items(multi=True))))
+
+def product_key(slug):
+	'''
+	Versioned like list_key, a load that started before invalidate_product cannot be read back
+	'''
+	return 'product:{}:{}'.format(get_version('products'), slug)
+
+def page_key(slug):
+	return 'page:{}:{}'.format(get_version('pages'), slug)
+
+def invalidate_product(*slugs):
+	for slug in slugs:
+		if slug:
+			_backend.delete(product_key(slug))
+	bump_version('products')
+
+def invalidate_page(*slugs):
+	for slug in slugs:
+		if slug:
+			_backend.delete(page_key(slug))
+	bump_version('pages')
+
+
+def invalidate_coupons():
+	bump_version('coupons')
+
+def invalidate_shipping():
+	bump_version('shipping')
+
+def invalidate_catalog():
+	'''
+	For product writes changing what the typeahead shows (titles, categories, statuses)
+	'''
+	bump_version('catalog')
\ No newline at end of file
@@ -0,0 +1,61 @@
+'''
+Conditional GET helpers (ETag / Last-Modified)
+
+A serialized payload is wrapped once with validated() so the ETag (a hash of the payload)
+and, for a single document, the Last-Modified date can be cached next to it. conditional_response() then answers
+If-None-Match / If-Modified-Since with a 304 before anything is serialized to JSON.
+'''
+
+from flask import current_app, jsonify, request
+
+import datetime, hashlib, json
+
+def make_etag(payload):
+	return hashlib.sha1(json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str).encode('utf8')).hexdigest()
+
+def _parse_modified(value):
+	try:
+		return datetime.datetime.fromisoformat(value)
+	except (TypeError, ValueError):
+		return None
+
+def last_modified(payload):
+	'''
+	The 'modified' date of a serialized document. Lists only get an ETag: the newest 'modified'
+	of their items does not move when an item is removed, unpublished or added with an older date
+	'''
+	if not isinstance(payload, dict):
+		return None
+	return _parse_modified(payload.get('modified'))
+
+def validated(payload):
+	modified = last_modified(payload)
+	return {
+		'body': payload,
+		'etag': make_etag(payload),
+		'lastModified': modified.isoformat() if modified else None
+	}
+
+def _http_date(value):
+	# Stored dates are naive local times, HTTP dates are UTC without microseconds
+	return value.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+def is_not_modified(etag, modified=None):
+	if request.if_none_match:
+		return request.if_none_match.contains(etag)
+	if modified and request.if_modified_since:
+		return _http_date(modified) <= request.if_modified_since
+	return False
+
+def conditional_response(entry, nextCursor=None):
+	modified = _parse_modified(entry.get('lastModified'))
+	if is_not_modified(entry['etag'], modified):
+		response = current_app.response_class(status=304)
+	else:
+		response = jsonify(entry['body'])
+	response.set_etag(entry['etag'])
+	if modified:
+		response.last_modified = _http_date(modified)
+	if nextCursor:
+		response.headers['X-Next-Cursor'] = nextCursor
+	return response
@@ -0,0 +1,97 @@
+'''
+Coupon code lookups served from the cache
+
+A code is resolved with one query the first time it is checked, and the result is cached under
+the 'coupons' version: the serialized coupon with its applicable product ids. Codes that do
+not exist get a negative entry in a small cache of their own, so repeated guesses of bad codes
+never reach Mongo and cannot push the catalog out of the shared cache.
+Admin coupon writes bump the version (invalidate_coupons), which drops every entry at once.
+
+Uses are counted when an order is placed, with one conditional $inc per coupon that only
+matches while uses < maxUses. Concurrent checkouts can therefore never oversell a limited
+coupon, and none of them waits on a lock. The couponsRedeemed flag of the order, claimed with
+findAndModify, makes redeeming and releasing idempotent.
+'''
+
+from database.models import Order, Coupon, _refId
+from resources.errors import CouponExhaustedError
+from services.cache_service import MemoryCache, cached, get_backend, get_version
+
+MISSING_CODES_SIZE = 4096
+MISSING_CODES_TTL = 60 # seconds
+
+_missingCodes = MemoryCache(MISSING_CODES_SIZE, MISSING_CODES_TTL)
+
+def coupon_code_key(code):
+	return 'coupon:{}:{}'.format(get_version('coupons'), code)
+
+def _load(code):
+	coupon = Coupon.objects(code=code).first()
+	if coupon is None or coupon.status == 'deactivated':
+		return None
+	return coupon.serialize()
+
+def get_coupon(code):
+	'''
+	The serialized coupon with this code, or None if there is no such active coupon
+	'''
+	if not isinstance(code, str) or not code:
+		return None
+	key = coupon_code_key(code)
+	if _missingCodes.get(key):
+		return None
+	entry = cached(key, lambda: _load(code))
+	if entry is None:
+		_missingCodes.set(key, True)
+	return entry
+
+def is_exhausted(coupon):
+	return coupon['maxUses'] != -1 and coupon['uses'] >= coupon['maxUses']
+
+def applies_to_cart(coupon, productIds):
+	'''
+	Whether the serialized coupon discounts at least one of the product ids
+	'''
+	if coupon['storeWide']:
+		return True
+	applicable = set(coupon['applicableProducts'])
+	return any(map(lambda id: str(id) in applicable, productIds))
+
+def _uses_changed(coupon):
+	# Only limited coupons can be refused, so only their cached use count has to be exact
+	if coupon is not None and coupon.maxUses != -1:
+		get_backend().delete(coupon_code_key(coupon.code))
+
+def _release(couponIds):
+	for couponId in couponIds:
+		_uses_changed(Coupon.objects(id=couponId, uses__gt=0).only('code', 'uses', 'maxUses').modify(inc__uses=-1, new=True))
+
+def redeem_coupons(orderId):
+	'''
+	Count one use of every coupon of the order. If one of them has no use left, nothing is
+	counted and CouponExhaustedError is raised. Returns False if the uses were already counted
+	'''
+	order = Order.objects(id=orderId, couponsRedeemed__ne=True).only('coupons').modify(set__couponsRedeemed=True)
+	if order is None:
+		return False
+	redeemed = []
+	for couponId in map(_refId, order._data.get('coupons') or []):
+		coupon = Coupon.objects(__raw__={
+			'_id': couponId,
+			'$or': [{ 'maxUses': -1 }, { '$expr': { '$lt': ['$uses', '$maxUses'] } }]
+		}).only('code', 'uses', 'maxUses').modify(inc__uses=1, new=True)
+		if coupon is None:
+			_release(redeemed)
+			Order.objects(id=orderId).update_one(set__couponsRedeemed=False)
+			raise CouponExhaustedError
+		redeemed.append(couponId)
+		_uses_changed(coupon)
+	return True
+
+def release_coupons(orderId):
+	'''
+	Give back the uses counted by redeem_coupons, for an order that failed
+	'''
+	order = Order.objects(id=orderId, couponsRedeemed=True).only('coupons').modify(set__couponsRedeemed=False)
+	if order is not None:
+		_release(map(_refId, order._data.get('coupons') or []))
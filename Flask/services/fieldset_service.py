@@ -0,0 +1,33 @@
+'''
+Sparse fieldset helpers for the list endpoints
+
+`fields=title,slug,price` limits both the Mongo projection and the serialized output
+to the requested fields. The id is always included.
+'''
+
+from resources.errors import SchemaValidationError
+
+def parse_fields(args, model):
+	'''
+	Returns the requested field names, or None if every field was requested
+	'''
+	fields = args.get('fields')
+	if not fields:
+		return None
+	requested = list(filter(None, map(lambda f: f.strip(), fields.split(','))))
+	for field in requested:
+		if field.startswith('_') or field not in model._fields:
+			raise SchemaValidationError
+	if 'id' not in requested:
+		requested.append('id')
+	return requested
+
+def apply_fields(queryset, fields):
+	if fields is None:
+		return queryset
+	return queryset.only(*fields)
+
+def trim_fields(serialized, fields):
+	if fields is None:
+		return serialized
+	return list(map(lambda s: { k: v for k, v in s.items() if k in fields }, serialized))
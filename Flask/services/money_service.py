@@ -0,0 +1,39 @@
+'''
+Integer cents money helpers
+
+Every amount in the pricing pipeline is an int number of cents. Int arithmetic is exact and much
+cheaper than Decimal, and rounding only happens in to_cents (at the boundary, half up) and
+percent_of, so every payment provider ends up with the same totals.
+'''
+
+from decimal import Decimal, ROUND_HALF_UP
+
+import math
+
+CENT = Decimal('0.01')
+
+def to_cents(amount):
+	'''
+	Convert a dollar amount (Decimal, float, int or str) to cents
+	'''
+	if amount is None:
+		return 0
+	if isinstance(amount, int):
+		return amount * 100
+	return int(Decimal(str(amount)).quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+def percent_of(cents, rate):
+	'''
+	rate is a fraction (0.0825 for 8.25%), the result is rounded half up to the cent
+	'''
+	return int(math.floor(cents * (rate or 0) + 0.5))
+
+def from_cents(cents):
+	return cents / 100
+
+def format_cents(cents):
+	'''
+	'12.34' for 1234, the format PayPal and Coinbase expect
+	'''
+	sign = '-' if cents < 0 else ''
+	return '{}{}.{:02d}'.format(sign, abs(cents) // 100, abs(cents) % 100)
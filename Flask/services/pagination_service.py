@@ -0,0 +1,96 @@
+'''
+Pagination helpers for the list endpoints
+
+Two modes are supported. The legacy `page`/`size` mode slices the queryset (a Mongo skip).
+Passing `cursor` (empty for the first page) switches to keyset pagination: the next page is
+selected with a range query on the sort key and `_id`, so deep pages cost the same as the first.
+The token for the following page is returned in the X-Next-Cursor header.
+'''
+
+from flask import jsonify
+from mongoengine.queryset.visitor import Q
+from bson import ObjectId
+
+from resources.errors import SchemaValidationError
+
+import base64, datetime, decimal, json
+
+MAX_PAGE_SIZE = 100
+
+def get_page_size(args):
+	size = int(args.get('size', MAX_PAGE_SIZE))
+	return max(0, min(size, MAX_PAGE_SIZE))
+
+def _encode_value(value):
+	if isinstance(value, datetime.datetime):
+		return {'date': value.isoformat()}
+	if isinstance(value, decimal.Decimal):
+		return float(value)
+	if isinstance(value, ObjectId):
+		return str(value)
+	return value
+
+def _decode_value(value):
+	if isinstance(value, dict):
+		return datetime.datetime.fromisoformat(value['date'])
+	return value
+
+def encode_cursor(document, key='id'):
+	values = [str(document.id)]
+	if key != 'id':
+		values.insert(0, _encode_value(getattr(document, key)))
+	return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf8')).decode('ascii')
+
+def decode_cursor(cursor, key='id'):
+	try:
+		values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+		lastId = ObjectId(values[-1])
+		if key == 'id':
+			return None, lastId
+		return _decode_value(values[0]), lastId
+	except Exception:
+		raise SchemaValidationError
+
+def _after_cursor(queryset, cursor, key, descending):
+	lastValue, lastId = decode_cursor(cursor, key)
+	op = 'lt' if descending else 'gt'
+	afterId = Q(**{'id__' + op: lastId})
+	if key == 'id':
+		return queryset.filter(afterId)
+	# Missing values sort first ascending and last descending
+	if lastValue is None:
+		if descending:
+			return queryset.filter(Q(**{key: None}) & afterId)
+		return queryset.filter(Q(**{key + '__ne': None}) | (Q(**{key: None}) & afterId))
+	after = Q(**{key + '__' + op: lastValue}) | (Q(**{key: lastValue}) & afterId)
+	if descending:
+		after = after | Q(**{key: None})
+	return queryset.filter(after)
+
+def paginate(queryset, args, key='id', descending=False):
+	'''
+	Returns the requested page of the queryset and the cursor of the following page (or None)
+	'''
+	size = get_page_size(args)
+	sign = '-' if descending else ''
+	if key == 'id':
+		queryset = queryset.order_by(sign + 'id')
+	else:
+		queryset = queryset.order_by(sign + key, sign + 'id')
+	cursor = args.get('cursor')
+	if cursor is None:
+		page = int(args.get('page', 0))
+		return list(queryset[page * size : page * size + size]), None
+	if cursor:
+		queryset = _after_cursor(queryset, cursor, key, descending)
+	items = list(queryset.limit(size + 1))
+	if len(items) > size:
+		items = items[:size]
+		return items, encode_cursor(items[-1], key) if items else None
+	return items, None
+
+def page_response(items, nextCursor):
+	response = jsonify(items)
+	if nextCursor:
+		response.headers['X-Next-Cursor'] = nextCursor
+	return response
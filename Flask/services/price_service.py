@@ -1,30 +1,130 @@
-def calculate_order_amount(items):
+'''
+Order pricing
+
+A set of coupons is compiled once into a product id -> ordered discounts map plus the list of
+store wide discounts, so pricing is O(items + coupons). Compiled sets are cached by the
+coupon ids and modified dates.
+
+Amounts are int cents (see money_service). calculate_totals is the one place computing the
+subtotal, discount, tax, shipping and total of an order, and every payment provider uses it.
+'''
+
+from collections import OrderedDict
+
+from database.models import Order, OrderTotals
+from services.money_service import to_cents, percent_of, from_cents
+
+import threading
+
+MAX_COMPILED = 256
+
+_compiled = OrderedDict()
+_compiledLock = threading.Lock()
+
+def _apply(price, rules):
+	for type, discount in rules:
+		if type == 'dollar':
+			price -= discount
+		elif type == 'percent':
+			price -= percent_of(price, discount)
+	return max(price, 0)
+
+class CompiledCoupons:
+	def __init__(self, coupons):
+		productRules = {}
+		storeWideRules = []
+		# Product discounts before store wide ones, dollar discounts before percent ones
+		for storeWide in [False, True]:
+			for type in ['dollar', 'percent']:
+				for coupon in coupons:
+					if coupon.discountType != type or bool(coupon.storeWide) != storeWide:
+						continue
+					if type == 'dollar':
+						rule = (type, to_cents(coupon.discount))
+					else:
+						rule = (type, (coupon.discount or 0) / 100.0)
+					if storeWide:
+						storeWideRules.append(rule)
+					else:
+						for productId in coupon.applicableProductIds:
+							productRules.setdefault(productId, []).append(rule)
+		self.productRules = { id: tuple(rules) for id, rules in productRules.items() }
+		self.storeWideRules = tuple(storeWideRules)
+
+	def item_price(self, item):
+		'''
+		Unit price of a cart line, in cents, after its product discounts
+		'''
+		return _apply(to_cents(item.price), self.productRules.get(item.productId, ()))
+
+	def total(self, items):
+		total = 0
+		for item in items:
+			total += self.item_price(item) * item.qty
+		return _apply(total, self.storeWideRules)
+
+def compile_coupons(coupons):
+	coupons = list(coupons)
+	key = tuple(map(lambda c: (str(c.id), str(c.modified)), coupons))
+	with _compiledLock:
+		compiled = _compiled.get(key)
+		if compiled is not None:
+			_compiled.move_to_end(key)
+			return compiled
+	compiled = CompiledCoupons(coupons)
+	with _compiledLock:
+		_compiled[key] = compiled
+		while len(_compiled) > MAX_COMPILED:
+			_compiled.popitem(last=False)
+	return compiled
+
+def calculate_subtotal(items):
 	total = 0
 	for item in items:
-		total += float(item.price) * item.qty
+		total += to_cents(item.price) * item.qty
 	return total
 
+def shipping_cost(discounted, shippingType=None, shippingRate=None):
+	'''
+	Shipping in cents, for a discounted subtotal in cents
+	'''
+	if shippingType == 'dollar':
+		return to_cents(shippingRate)
+	elif shippingType == 'percent':
+		return percent_of(discounted, shippingRate)
+	return 0
+
+def calculate_totals(items, coupons, taxRate=None, shippingType=None, shippingRate=None):
+	subtotal = calculate_subtotal(items)
+	discounted = compile_coupons(coupons).total(items)
+	tax = percent_of(discounted, taxRate)
+	shipping = shipping_cost(discounted, shippingType, shippingRate)
+	return OrderTotals(
+		subtotal=subtotal,
+		discount=subtotal - discounted,
+		tax=tax,
+		shipping=shipping,
+		total=discounted + tax + shipping
+	)
+
+def price_order(order):
+	'''
+	Compute and persist the totals of the order. Call after anything they depend on changes
+	'''
+	order.totals = calculate_totals(order.products, order.coupons, order.taxRate, order.shippingType, order.shippingRate)
+	Order.objects(id=order.id).update_one(set__totals=order.totals)
+	return order.totals
+
+def order_totals(order):
+	'''
+	The persisted totals of the order, computed on first use
+	'''
+	if order.totals is None:
+		return price_order(order)
+	return order.totals
+
+def calculate_order_amount(items):
+	return from_cents(calculate_subtotal(items))
+
 def calculate_discount_price(items, coupons):
-	sortedCoupons = []
-	for storeWide in [False, True]:
-		for type in ['dollar', 'percent']:
-			for coupon in coupons:
-				if coupon.discountType == type and coupon.storeWide == storeWide:
-					sortedCoupons.append(coupon)
-	total = 0
-	for item in items:
-		currentPrice = float(item.price)
-		for coupon in sortedCoupons:
-			if str(item.product.id) in coupon.applicableProducts and not coupon.storeWide:
-				if coupon.discountType == 'dollar':
-					currentPrice -= coupon.discount
-				elif coupon.discountType == 'percent':
-					currentPrice -= currentPrice * (coupon.discount / 100.0)
-		total += currentPrice * item.qty
-	for coupon in sortedCoupons:
-		if coupon.storeWide:
-			if coupon.discountType == 'dollar':
-				total -= coupon.discount
-			elif coupon.discountType == 'percent':
-				total -= total * (coupon.discount / 100.0)
-	return total
\ No newline at end of file
+	return from_cents(compile_coupons(coupons).total(items))
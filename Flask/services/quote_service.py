@@ -0,0 +1,104 @@
+'''
+Stateless cart price quotes
+
+A quote prices cart lines, coupon codes and a shipping ZIP/state exactly like an order would be
+priced, without writing anything. Quotes are memoized under a hash of the normalized inputs and
+of the products, coupons, tax and shipping cache versions, so the checkout page can re-quote on
+every change of the address form and a catalog, coupon or rate change still shows up at once.
+'''
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from database.models import Product, Coupon, CartItem
+from resources.errors import SchemaValidationError
+from services.cache_service import MemoryCache, cached, get_version
+from services.money_service import to_cents, from_cents
+from services.price_service import compile_coupons, calculate_totals
+from services.shipping_service import get_shipping_zone
+from services.tax_service import get_tax_rate
+
+import hashlib, json
+
+QUOTE_VERSIONS = ['products', 'coupons', 'tax', 'shipping']
+
+QUOTES_SIZE = 1024
+QUOTES_TTL = 60 # seconds
+
+_quotes = MemoryCache(QUOTES_SIZE, QUOTES_TTL) # kept out of the shared cache, see cached()
+
+def _normalize(cart, codes, zip, state):
+	if not isinstance(cart, list):
+		raise SchemaValidationError
+	lines = {}
+	try:
+		for line in cart:
+			productId = str(ObjectId(line['id']))
+			qty = int(line.get('qty', 1))
+			if qty <= 0:
+				raise SchemaValidationError
+			lines[productId] = lines.get(productId, 0) + qty
+	except (KeyError, TypeError, ValueError, InvalidId):
+		raise SchemaValidationError
+	codes = sorted(set(filter(lambda c: isinstance(c, str) and c, codes or [])))
+	try:
+		zip = str(int(zip)) if zip else None # strip leading 0s if present
+	except ValueError:
+		zip = None
+	state = state.upper() if isinstance(state, str) and state else None
+	return sorted(lines.items()), codes, zip, state
+
+def quote_key(lines, codes, zip, state):
+	inputs = [lines, codes, zip, state, list(map(get_version, QUOTE_VERSIONS))]
+	return 'quote:' + hashlib.sha1(json.dumps(inputs, separators=(',', ':')).encode('utf8')).hexdigest()
+
+def _quote(lines, codes, zip, state):
+	products = { str(p.id): p for p in Product.objects(id__in=list(map(lambda l: l[0], lines))).only('price') }
+	if len(products) != len(lines):
+		raise SchemaValidationError
+	items = list(map(lambda l: CartItem(product=products[l[0]], qty=l[1], price=products[l[0]].price), lines))
+
+	coupons = []
+	if codes:
+		for coupon in Coupon.objects(code__in=codes, status__ne='deactivated'):
+			if coupon.maxUses == -1 or coupon.uses < coupon.maxUses:
+				coupons.append(coupon)
+	coupons.sort(key=lambda c: c.code)
+	compiled = compile_coupons(coupons)
+
+	taxRate = get_tax_rate(zip) if zip else None
+
+	shippingRate = None
+	zone = get_shipping_zone(state) if state else None
+	if zone is not None:
+		shippingRate = zone.select(from_cents(compiled.total(items)))
+
+	totals = calculate_totals(
+		items,
+		coupons,
+		taxRate,
+		shippingRate.type if shippingRate else None,
+		shippingRate.rate if shippingRate else None
+	)
+	applied = list(map(lambda c: c.code, coupons))
+	return {
+		'lines': list(map(lambda i: {
+			'id': i.productId,
+			'qty': i.qty,
+			'price': from_cents(to_cents(i.price)),
+			'discountedPrice': from_cents(compiled.item_price(i))
+		}, items)),
+		'coupons': applied,
+		'invalidCoupons': list(filter(lambda c: c not in applied, codes)),
+		'taxRate': taxRate,
+		'shippingRate': shippingRate.serialize() if shippingRate else None,
+		'totals': totals.serialize()
+	}
+
+def quote_cart(cart, codes=None, zip=None, state=None):
+	'''
+	The full price breakdown of the cart. Raises SchemaValidationError for malformed lines or
+	unknown products
+	'''
+	lines, codes, zip, state = _normalize(cart, codes, zip, state)
+	return cached(quote_key(lines, codes, zip, state), lambda: _quote(lines, codes, zip, state), _quotes)
@@ -0,0 +1,313 @@
+'''
+In-memory product search engine
+
+An alternative to the Mongo $text index, enabled with app.config['SEARCH_ENGINE'] = 'memory'.
+Published products are indexed by the same ngrams as Post.generateNgrams, with the same field
+weights as the text index. Each ngram maps to a posting list of product ordinals (array('I'))
+and a parallel array of weighted term frequencies (array('f')), and matches are ranked with BM25,
+summed with NumPy over the posting lists of the query terms.
+
+Admin writes update the index incrementally (removed products are tombstoned until the next
+compaction). The index is pickled to app.config['SEARCH_SNAPSHOT'] so new workers load it
+instead of rebuilding, then catch up with the products modified since the snapshot was taken.
+A worker saves the snapshot in the background when its index changed and the snapshot is older
+than SNAPSHOT_INTERVAL.
+'''
+
+from array import array
+from operator import itemgetter
+from bson import ObjectId
+from mongoengine.queryset.visitor import Q
+
+from app import app
+from database.models import Product
+from services.cache_service import get_version
+from services.util_service import make_ngrams, write_atomic
+
+import datetime, math, os, pickle, threading, time
+import numpy as np
+
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_INTERVAL = 15 * 60 # seconds
+
+# Same ratios as the weights of the Post text index
+TITLE_WEIGHT = 1.0
+TITLE_PREFIX_WEIGHT = 2.0
+CATEGORY_PREFIX_WEIGHT = 0.2
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+COMPACT_RATIO = 0.2
+
+INDEX_ONLY = ('title', 'categories', 'status', 'modified')
+
+def product_terms(title, categories):
+	'''
+	Weighted ngram frequencies of a product
+	'''
+	terms = {}
+	def add(ngrams, weight):
+		for ngram in ngrams:
+			terms[ngram] = terms.get(ngram, 0) + weight
+	for word in (title or '').lower().split():
+		add(make_ngrams(word), TITLE_WEIGHT)
+		add(make_ngrams(word, prefix_only=True), TITLE_PREFIX_WEIGHT)
+	for category in categories or []:
+		for word in category.lower().split():
+			add(make_ngrams(word, prefix_only=True), CATEGORY_PREFIX_WEIGHT)
+	return terms
+
+class SearchIndex:
+	def __init__(self):
+		self.ids = [] # ordinal -> product id
+		self.ordinals = {} # product id -> live ordinal
+		self.lengths = array('f') # ordinal -> document length
+		self.live = bytearray() # ordinal -> 1, or 0 once removed
+		self.postings = {} # ngram -> (array('I') of ordinals, array('f') of frequencies)
+		self.totalLength = 0.0
+		self.builtAt = None
+		self.version = None
+		self._lock = threading.Lock()
+		self._columns = None # NumPy copies of lengths and live, dropped by any update
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_lock']
+		del state['_columns']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+		self._columns = None
+
+	def __len__(self):
+		return len(self.ordinals)
+
+	def _add(self, id, title, categories):
+		terms = product_terms(title, categories)
+		ordinal = len(self.ids)
+		self.ids.append(id)
+		self.ordinals[id] = ordinal
+		length = sum(terms.values())
+		self.lengths.append(length)
+		self.live.append(1)
+		self.totalLength += length
+		for term, frequency in terms.items():
+			posting = self.postings.get(term)
+			if posting is None:
+				posting = self.postings[term] = (array('I'), array('f'))
+			posting[0].append(ordinal)
+			posting[1].append(frequency)
+
+	def _remove(self, id):
+		ordinal = self.ordinals.pop(id, None)
+		if ordinal is not None:
+			self.live[ordinal] = 0
+			self.totalLength -= self.lengths[ordinal]
+
+	def update(self, product):
+		'''
+		Index, reindex or unindex a product according to its status
+		'''
+		with self._lock:
+			self._columns = None
+			id = str(product.id)
+			self._remove(id)
+			if product.status == 'publish':
+				self._add(id, product.title, product.categories)
+			if len(self.ids) - len(self.ordinals) > COMPACT_RATIO * max(len(self.ids), 1):
+				self._compact()
+
+	def _compact(self):
+		live = [None] * len(self.ids)
+		for id, ordinal in self.ordinals.items():
+			live[ordinal] = id
+		remap = {}
+		for ordinal, id in enumerate(live):
+			if id is not None:
+				remap[ordinal] = len(remap)
+		postings = {}
+		for term, (ordinals, frequencies) in self.postings.items():
+			newOrdinals, newFrequencies = array('I'), array('f')
+			for ordinal, frequency in zip(ordinals, frequencies):
+				if ordinal in remap:
+					newOrdinals.append(remap[ordinal])
+					newFrequencies.append(frequency)
+			if newOrdinals:
+				postings[term] = (newOrdinals, newFrequencies)
+		self.ids = [id for id in live if id is not None]
+		self.ordinals = { id: ordinal for ordinal, id in enumerate(self.ids) }
+		self.lengths = array('f', (self.lengths[ordinal] for ordinal in sorted(remap)))
+		self.live = bytearray(b'\1' * len(self.ids))
+		self.postings = postings
+
+	def search(self, q, limit):
+		'''
+		The ids and scores of the best limit matches of q, best first
+		'''
+		if limit <= 0:
+			return []
+		# The arrays are copied under the lock, an update cannot append to an exported buffer
+		with self._lock:
+			count = len(self.ordinals)
+			if count == 0:
+				return []
+			averageLength = self.totalLength / count or 1.0
+			postings = list(filter(None, map(self.postings.get, set(q.lower().split()))))
+			if not postings:
+				return []
+			if self._columns is None:
+				self._columns = (np.array(self.lengths, dtype=np.float32), np.array(self.live, dtype=np.float32))
+			lengths, live = self._columns
+			scores = np.zeros(len(self.ids), dtype=np.float32)
+			matched = []
+			for ordinals, frequencies in postings:
+				df = len(ordinals)
+				idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+				# An ordinal appears once per posting list, so the fancy-indexed add is safe
+				ordinals = np.array(ordinals, dtype=np.uint32)
+				frequencies = np.array(frequencies, dtype=np.float32)
+				norm = K1 * (1 - B + B * lengths[ordinals] / averageLength)
+				scores[ordinals] += idf * frequencies * (K1 + 1) / (frequencies + norm)
+				matched.append(ordinals)
+			if len(matched) == 1:
+				matches = matched[0]
+			elif sum(map(len, matched)) < len(scores) // 16:
+				matches = np.unique(np.concatenate(matched))
+			else:
+				# Every contribution is positive, so the scored ordinals are the nonzero ones
+				matches = np.flatnonzero(scores)
+			matches = matches[live[matches] > 0]
+			ids = self.ids
+		if len(matches) > limit:
+			matches = matches[np.argpartition(-scores[matches], limit - 1)[:limit]]
+		matches = matches[np.argsort(-scores[matches], kind='stable')]
+		return list(map(lambda ordinal: (ids[ordinal], float(scores[ordinal])), matches))
+
+	def catch_up(self):
+		'''
+		Apply the product writes made since the index was built (by this or another worker)
+		'''
+		since = self.builtAt
+		self.builtAt = datetime.datetime.now()
+		self.version = get_version('products')
+		products = Product.objects(Q(modified__gte=since) | Q(id__gte=ObjectId.from_datetime(since.astimezone(datetime.timezone.utc)))).only(*INDEX_ONLY)
+		for product in products:
+			self.update(product)
+
+	@classmethod
+	def build(cls):
+		index = cls()
+		index.builtAt = datetime.datetime.now()
+		index.version = get_version('products')
+		for product in Product.objects(status='publish').only(*INDEX_ONLY):
+			index._add(str(product.id), product.title, product.categories)
+		return index
+
+	def save(self, path):
+		with self._lock:
+			data = pickle.dumps((SNAPSHOT_FORMAT, self), protocol=pickle.HIGHEST_PROTOCOL)
+		write_atomic(path, lambda f: f.write(data))
+
+	@classmethod
+	def load(cls, path):
+		with open(path, 'rb') as f:
+			format, index = pickle.load(f)
+		if format != SNAPSHOT_FORMAT:
+			raise ValueError('Unsupported search snapshot format')
+		return index
+
+_index = None
+_indexLock = threading.Lock()
+_saving = False
+_savedAt = time.monotonic()
+_savedVersion = None
+
+def search_enabled():
+	return app.config.get('SEARCH_ENGINE') == 'memory'
+
+def get_index():
+	'''
+	The process wide index, loaded from the snapshot (or built) on first use
+	'''
+	global _index
+	if _index is None:
+		with _indexLock:
+			if _index is None:
+				path = app.config.get('SEARCH_SNAPSHOT')
+				index = None
+				if path and os.path.isfile(path):
+					try:
+						index = SearchIndex.load(path)
+						index.catch_up()
+					except Exception as e:
+						app.logger.warning('Could not load the search snapshot: ' + str(e))
+						index = None
+				if index is None:
+					index = SearchIndex.build()
+					if path:
+						index.save(path)
+						_saved(index.version)
+				_index = index
+	elif _index.version != get_version('products'):
+		# Differs after a product write not followed by index_product, e.g. one made by another
+		# worker sharing the cache backend
+		with _indexLock:
+			if _index.version != get_version('products'):
+				_index.catch_up()
+	_save_if_stale()
+	return _index
+
+def _saved(version):
+	global _savedAt, _savedVersion
+	_savedAt = time.monotonic()
+	_savedVersion = version
+
+def _save(index, path, version):
+	global _saving
+	try:
+		index.save(path)
+		_saved(version)
+	except Exception as e:
+		app.logger.warning('Could not save the search snapshot: ' + str(e))
+	finally:
+		_saving = False
+
+def _save_if_stale():
+	'''
+	Save the snapshot in the background if the index changed since it was last saved, at most
+	every SNAPSHOT_INTERVAL (the scheduler does not run under uwsgi)
+	'''
+	global _saving
+	path = app.config.get('SEARCH_SNAPSHOT')
+	if not path or _saving or _index.version == _savedVersion or time.monotonic() - _savedAt < SNAPSHOT_INTERVAL:
+		return
+	with _indexLock:
+		if _saving:
+			return
+		_saving = True
+	threading.Thread(target=_save, args=(_index, path, _index.version), daemon=True).start()
+
+def index_product(product):
+	if search_enabled() and _index is not None:
+		_index.update(product)
+		# Call after invalidate_product, whose version bump this write accounts for
+		if _index.version == get_version('products') - 1:
+			_index.version += 1
+
+def search_products(q, page, size):
+	'''
+	The ids of the requested page of matches
+	'''
+	results = get_index().search(q, (page + 1) * size)
+	return list(map(itemgetter(0), results[page * size:]))
+
+def save_snapshot():
+	path = app.config.get('SEARCH_SNAPSHOT')
+	if search_enabled() and path and _index is not None:
+		version = _index.version
+		_index.save(path)
+		_saved(version)
@@ -0,0 +1,119 @@
+'''
+US shipping zone and rate selection, shared by checkout and the cart quotes
+
+Every zone is loaded with one query into a state -> zone map (plus the default zone), and the
+rates of each zone are compiled into sorted cutoff points. Between two consecutive cutoffs, and
+on each cutoff itself, the set of matching rates never changes, so the selected rate of every
+such segment is computed once and a lookup is a bisect of the price.
+
+The resolver is rebuilt the first time it is used after a shipping zone write (tracked with the
+'shipping' cache version).
+'''
+
+from bisect import bisect_left
+
+from database.models import UsShippingZone
+from services.cache_service import get_version
+from services.money_service import to_cents, from_cents
+from services.price_service import shipping_cost
+
+import threading
+
+def select_shipping_rate(rates, price):
+	'''
+	The rate whose cutoffs bound the price (in dollars) most tightly, or None.
+	Linear in the rates, only used to compile the zones
+	'''
+	rateCandidates = []
+	for rate in rates:
+		if ((rate.minCutoff != None and rate.minCutoff < price) or rate.minCutoff == None) and ((rate.maxCutoff != None and rate.maxCutoff > price) or rate.maxCutoff == None):
+			rateCandidates.append(rate)
+	match = None
+	for candidate in rateCandidates:
+		if match == None:
+			match = candidate
+		else:
+			if match.minCutoff == None and candidate.minCutoff != None:
+				match = candidate
+			elif match.maxCutoff == None and candidate.maxCutoff != None:
+				match = candidate
+			elif None not in (match.minCutoff, match.maxCutoff, candidate.minCutoff, candidate.maxCutoff) and match.maxCutoff - match.minCutoff > candidate.maxCutoff - candidate.minCutoff:
+				match = candidate
+	return match
+
+class CompiledZone:
+	def __init__(self, zone):
+		self.serialized = zone.serialize()
+		rates = list(zone.rates)
+		cutoffs = set()
+		for rate in rates:
+			cutoffs.update(filter(lambda c: c is not None, (rate.minCutoff, rate.maxCutoff)))
+		self.cutoffs = sorted(cutoffs)
+		# Segment 2i is the open interval below cutoffs[i] (above cutoffs[i - 1]), 2i + 1 is cutoffs[i] itself
+		self.segments = []
+		for i, cutoff in enumerate(self.cutoffs):
+			below = self.cutoffs[i - 1] if i > 0 else cutoff - 1
+			self.segments.append(select_shipping_rate(rates, (below + cutoff) / 2))
+			self.segments.append(select_shipping_rate(rates, cutoff))
+		last = self.cutoffs[-1] + 1 if self.cutoffs else 0
+		self.segments.append(select_shipping_rate(rates, last))
+
+	def select(self, price):
+		'''
+		The selected ShippingRate for the price in dollars, or None
+		'''
+		i = bisect_left(self.cutoffs, price)
+		if i < len(self.cutoffs) and self.cutoffs[i] == price:
+			return self.segments[2 * i + 1]
+		return self.segments[2 * i]
+
+class ShippingResolver:
+	def __init__(self, zones):
+		self.states = {}
+		self.default = None
+		for zone in zones:
+			compiled = CompiledZone(zone)
+			for state in zone.applicableStates or []:
+				self.states[state] = compiled
+			if zone.default:
+				self.default = compiled
+
+	def zone(self, state):
+		return self.states.get(state, self.default)
+
+_resolver = None
+_resolverLock = threading.Lock()
+
+def get_resolver():
+	global _resolver
+	version = get_version('shipping')
+	if _resolver is None or _resolver[0] != version:
+		with _resolverLock:
+			if _resolver is None or _resolver[0] != version:
+				_resolver = (version, ShippingResolver(UsShippingZone.objects()))
+	return _resolver[1]
+
+def get_shipping_zone(state):
+	'''
+	The compiled zone of the state, or the default zone, or None if there is neither
+	'''
+	return get_resolver().zone(state)
+
+def quote_shipping(state, subtotals):
+	'''
+	The selected rate and the shipping cost (in cents) of each subtotal (in dollars), or None
+	if the state has no zone
+	'''
+	zone = get_shipping_zone(state)
+	if zone is None:
+		return None
+	quotes = []
+	for subtotal in subtotals:
+		cents = to_cents(subtotal)
+		rate = zone.select(from_cents(cents))
+		quotes.append({
+			'subtotal': from_cents(cents),
+			'shippingRate': rate.serialize() if rate else None,
+			'shipping': shipping_cost(cents, rate.type, rate.rate) if rate else None
+		})
+	return quotes
@@ -0,0 +1,141 @@
+'''
+Bulk import of the US tax rates
+
+Reads the standard per-state rate CSVs (State, ZipCode, TaxRegionName, EstimatedCombinedRate,
+StateRate, EstimatedCountyRate, EstimatedCityRate, EstimatedSpecialRate, RiskLevel) as a stream,
+and upserts them into UsTaxJurisdiction in chunks: one $in to read the current rates of the
+chunk, then one unordered bulk_write of the new and changed rows only. The report lists the
+rates that changed. The tax table is rebuilt afterwards (see tax_service.rebuild_table).
+
+Available to admins at admin/tax/import and on the command line:
+
+	FLASK_APP=app flask import-tax-rates TAXRATES_ZIP5_*.csv
+'''
+
+from pymongo import UpdateOne
+
+from app import app
+from database.models import UsTaxJurisdiction
+from resources.errors import SchemaValidationError
+from services.tax_service import normalize_zip, rebuild_table
+
+import click, csv
+
+CHUNK_SIZE = 5000
+MAX_REPORTED_CHANGES = 1000
+
+COLUMNS = {
+	'State': 'state',
+	'TaxRegionName': 'taxRegion',
+	'StateRate': 'stateRate',
+	'EstimatedCombinedRate': 'estimatedCombinedRate',
+	'EstimatedCountyRate': 'estimatedCountyRate',
+	'EstimatedCityRate': 'estimatedCityRate',
+	'EstimatedSpecialRate': 'estimatedSpecialRate',
+	'RiskLevel': 'riskLevel'
+}
+RATE_FIELDS = ['stateRate', 'estimatedCombinedRate', 'estimatedCountyRate', 'estimatedCityRate', 'estimatedSpecialRate']
+
+def _number(value, type):
+	value = (value or '').strip()
+	return type(value) if value else None
+
+def parse_row(row):
+	'''
+	The stored ZIP and fields of a CSV row, or None if the row is malformed
+	'''
+	zip = normalize_zip(row.get('ZipCode'))
+	if zip is None:
+		return None
+	try:
+		fields = {
+			'state': (row.get('State') or '').strip().upper(),
+			'taxRegion': (row.get('TaxRegionName') or '').strip(),
+			'riskLevel': _number(row.get('RiskLevel'), int)
+		}
+		for column, field in COLUMNS.items():
+			if field in RATE_FIELDS:
+				fields[field] = _number(row.get(column), float)
+	except ValueError:
+		return None
+	return str(zip), fields
+
+def new_report():
+	return {
+		'rows': 0,
+		'inserted': 0,
+		'updated': 0,
+		'unchanged': 0,
+		'skipped': 0,
+		'changes': [] # { zip, field, old, new } of the changed rates, at most MAX_REPORTED_CHANGES
+	}
+
+def _write_chunk(rows, report):
+	collection = UsTaxJurisdiction._get_collection()
+	current = { d['_id']: d for d in collection.find({ '_id': { '$in': list(rows) } }, list(COLUMNS.values())) }
+	operations = []
+	for zip, fields in rows.items():
+		old = current.get(zip)
+		if old is None:
+			report['inserted'] += 1
+		elif all(map(lambda f: old.get(f) == fields[f], fields)):
+			report['unchanged'] += 1
+			continue
+		else:
+			report['updated'] += 1
+			for field in RATE_FIELDS:
+				if old.get(field) != fields[field] and len(report['changes']) < MAX_REPORTED_CHANGES:
+					report['changes'].append({ 'zip': zip, 'field': field, 'old': old.get(field), 'new': fields[field] })
+		operations.append(UpdateOne({ '_id': zip }, { '$set': fields }, upsert=True))
+	if operations:
+		collection.bulk_write(operations, ordered=False)
+
+def import_tax_csv(stream, report=None, chunkSize=CHUNK_SIZE):
+	'''
+	Import one CSV from a text stream. Does not rebuild the tax table
+	'''
+	report = report if report is not None else new_report()
+	reader = csv.DictReader(stream)
+	if not reader.fieldnames or 'ZipCode' not in reader.fieldnames or 'EstimatedCombinedRate' not in reader.fieldnames:
+		raise SchemaValidationError
+	rows = {}
+	for row in reader:
+		report['rows'] += 1
+		parsed = parse_row(row)
+		if parsed is None:
+			report['skipped'] += 1
+			continue
+		rows[parsed[0]] = parsed[1]
+		if len(rows) >= chunkSize:
+			_write_chunk(rows, report)
+			rows = {}
+	if rows:
+		_write_chunk(rows, report)
+	return report
+
+def import_tax_rates(streams):
+	'''
+	Import CSVs from text streams, then rebuild the tax table if anything changed
+	'''
+	report = new_report()
+	for stream in streams:
+		import_tax_csv(stream, report)
+	if report['inserted'] or report['updated']:
+		report['version'] = rebuild_table().version
+	return report
+
+@app.cli.command('import-tax-rates')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def importTaxRatesCommand(paths):
+	'''
+	Import US tax rate CSVs
+	'''
+	files = list(map(lambda p: open(p, newline='', encoding='utf-8-sig'), paths))
+	try:
+		report = import_tax_rates(files)
+	finally:
+		for f in files:
+			f.close()
+	for change in report['changes']:
+		click.echo('{zip} {field}: {old} -> {new}'.format(**change))
+	click.echo('{rows} rows: {inserted} inserted, {updated} updated, {unchanged} unchanged, {skipped} skipped'.format(**report))
@@ -0,0 +1,253 @@
+'''
+In-memory US tax table
+
+The ~42k UsTaxJurisdiction documents are packed into parallel arrays: the sorted int ZIPs, one
+float32 column per rate, the risk levels and indices into the (short) lists of states and tax
+regions. A lookup is a binary search on the ZIPs, with no query.
+
+The arrays are saved as one binary snapshot at app.config['TAX_SNAPSHOT'] and memory-mapped,
+so every worker process shares the same pages and a restart does not reload the collection.
+The table is reloaded when the 'tax' cache version changes (see rebuild_table), or when the
+snapshot file is replaced by another process, e.g. by flask import-tax-rates, which does not
+share the cache of the server.
+'''
+
+from array import array
+from bisect import bisect_left
+
+from app import app
+from database.models import UsTaxJurisdiction
+from services.cache_service import get_version, bump_version
+from services.util_service import write_atomic
+
+import json, math, mmap, os, struct, threading, time
+
+SNAPSHOT_MAGIC = b'USTAX'
+SNAPSHOT_FORMAT = 1
+HEADER = struct.Struct('=5sBxxII') # magic, format, row count, strings length
+
+RATE_FIELDS = ['stateRate', 'estimatedCombinedRate', 'estimatedCountyRate', 'estimatedCityRate', 'estimatedSpecialRate']
+RATE_DIGITS = 6 # float32 keeps ~7 significant digits, the published rates have at most 6 decimals
+
+STAT_INTERVAL = 1.0 # seconds between two checks of the snapshot file
+
+def normalize_zip(zip):
+	'''
+	The ZIP as an int (leading 0s stripped, like the stored ZIPs), or None if it is not a number
+	'''
+	try:
+		zip = int(str(zip).strip())
+	except (TypeError, ValueError):
+		return None
+	return zip if 0 <= zip <= 99999 else None
+
+def _align(offset):
+	return (offset + 7) & ~7
+
+def _rate(value):
+	return None if math.isnan(value) else round(value, RATE_DIGITS)
+
+def _file_id(stat):
+	return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+class TaxTable:
+	def __init__(self, zips, rates, riskLevels, stateIndices, regionIndices, states, regions):
+		self.zips = zips # int32, sorted
+		self.rates = rates # one float32 column per RATE_FIELDS entry, NaN when missing
+		self.riskLevels = riskLevels # int32, -1 when missing
+		self.stateIndices = stateIndices # uint16 into states
+		self.regionIndices = regionIndices # uint16 into regions
+		self.states = states
+		self.regions = regions
+		self.version = None
+		self.fileId = None # the snapshot file the table was mapped from
+		self.checkedAt = time.monotonic()
+		self._mmap = None
+
+	def __len__(self):
+		return len(self.zips)
+
+	def _find(self, zip):
+		i = bisect_left(self.zips, zip)
+		if i < len(self.zips) and self.zips[i] == zip:
+			return i
+		return None
+
+	def _row(self, i):
+		row = {
+			'zip': str(self.zips[i]),
+			'state': self.states[self.stateIndices[i]],
+			'taxRegion': self.regions[self.regionIndices[i]],
+			'riskLevel': self.riskLevels[i] if self.riskLevels[i] >= 0 else None
+		}
+		for field, column in zip(RATE_FIELDS, self.rates):
+			row[field] = _rate(column[i])
+		return row
+
+	def get(self, zip):
+		'''
+		The serialized jurisdiction of the ZIP (any format normalize_zip accepts), or None
+		'''
+		zip = normalize_zip(zip)
+		i = self._find(zip) if zip is not None else None
+		return self._row(i) if i is not None else None
+
+	def combined_rate(self, zip):
+		zip = normalize_zip(zip)
+		i = self._find(zip) if zip is not None else None
+		return _rate(self.rates[1][i]) if i is not None else None
+
+	@classmethod
+	def build(cls):
+		fields = ['state', 'taxRegion', 'riskLevel'] + RATE_FIELDS
+		rows = []
+		for document in UsTaxJurisdiction._get_collection().find({}, fields):
+			zip = normalize_zip(document['_id'])
+			if zip is not None:
+				rows.append((zip, document))
+		rows.sort(key=lambda r: r[0])
+		states, regions = {}, {}
+		def index(strings, value):
+			return strings.setdefault(value or '', len(strings))
+		def value(document, field):
+			v = document.get(field)
+			return float('nan') if v is None else float(v)
+		table = cls(
+			array('i', map(lambda r: r[0], rows)),
+			list(map(lambda field: array('f', map(lambda r: value(r[1], field), rows)), RATE_FIELDS)),
+			array('i', map(lambda r: r[1].get('riskLevel') if r[1].get('riskLevel') is not None else -1, rows)),
+			array('H', map(lambda r: index(states, r[1].get('state')), rows)),
+			array('H', map(lambda r: index(regions, r[1].get('taxRegion')), rows)),
+			list(states),
+			list(regions)
+		)
+		return table
+
+	def _columns(self):
+		return [self.zips] + self.rates + [self.riskLevels, self.stateIndices, self.regionIndices]
+
+	def save(self, path):
+		strings = json.dumps({ 'states': self.states, 'regions': self.regions }).encode('utf8')
+		def write(f):
+			f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, len(self.zips), len(strings)))
+			f.write(strings)
+			offset = HEADER.size + len(strings)
+			for column in self._columns():
+				f.write(b'\0' * (_align(offset) - offset))
+				offset = _align(offset)
+				f.write(column.tobytes())
+				offset += len(column) * column.itemsize
+		write_atomic(path, write)
+
+	@classmethod
+	def load(cls, path):
+		'''
+		Memory-map a snapshot, the columns are views of the mapped file
+		'''
+		with open(path, 'rb') as f:
+			mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			fileId = _file_id(os.fstat(f.fileno()))
+		view = memoryview(mapped)
+		magic, format, count, stringsLength = HEADER.unpack_from(view)
+		if magic != SNAPSHOT_MAGIC or format != SNAPSHOT_FORMAT:
+			raise ValueError('Unsupported tax snapshot format')
+		offset = HEADER.size
+		strings = json.loads(bytes(view[offset:offset + stringsLength]).decode('utf8'))
+		offset += stringsLength
+		columns = []
+		for typecode in ['i'] + ['f'] * len(RATE_FIELDS) + ['i', 'H', 'H']:
+			offset = _align(offset)
+			size = count * array(typecode).itemsize
+			columns.append(view[offset:offset + size].cast(typecode))
+			offset += size
+		table = cls(columns[0], columns[1:1 + len(RATE_FIELDS)], *columns[1 + len(RATE_FIELDS):], strings['states'], strings['regions'])
+		table.fileId = fileId
+		table._mmap = mapped
+		return table
+
+_table = None
+_tableLock = threading.Lock()
+
+def _snapshot_path():
+	return app.config.get('TAX_SNAPSHOT')
+
+def _load_or_build(rebuild=False):
+	path = _snapshot_path()
+	if path and os.path.isfile(path) and not rebuild:
+		try:
+			return TaxTable.load(path)
+		except Exception as e:
+			app.logger.warning('Could not load the tax snapshot: ' + str(e))
+	table = TaxTable.build()
+	if path:
+		table.save(path)
+		return TaxTable.load(path)
+	return table
+
+def _snapshot_id():
+	path = _snapshot_path()
+	try:
+		return _file_id(os.stat(path)) if path else None
+	except OSError:
+		return None
+
+def _snapshot_replaced(table):
+	'''
+	Whether a new snapshot was saved since the table was mapped, checked every STAT_INTERVAL
+	'''
+	now = time.monotonic()
+	if table.fileId is None or now - table.checkedAt < STAT_INTERVAL:
+		return False
+	table.checkedAt = now
+	fileId = _snapshot_id()
+	return fileId is not None and fileId != table.fileId
+
+def get_table():
+	'''
+	The process wide table, memory-mapped from the snapshot (built first if missing)
+	'''
+	global _table
+	version = get_version('tax')
+	if _table is None or _table.version != version or _snapshot_replaced(_table):
+		with _tableLock:
+			if _table is None or _table.version != version:
+				# After a rebuild by another worker, the snapshot it saved is the new table
+				table = _load_or_build()
+				table.version = version
+				_table = table
+			elif _table.fileId is not None and _snapshot_id() not in (None, _table.fileId):
+				# Saved by a process that does not share our cache, bump the version for it so
+				# the cached quotes (and the other workers sharing our cache) pick up the new rates
+				table = _load_or_build()
+				table.version = bump_version('tax')
+				_table = table
+	return _table
+
+def rebuild_table():
+	'''
+	Rebuild the table and its snapshot from the collection, then bump the 'tax' version so
+	every worker sharing the cache (and the cached quotes) pick up the new rates. The workers
+	of other processes pick up the new snapshot file instead (see get_table)
+	'''
+	global _table
+	with _tableLock:
+		table = _load_or_build(rebuild=True)
+		table.version = bump_version('tax')
+		_table = table
+	return table
+
+def get_tax_jurisdiction(zip):
+	return get_table().get(zip)
+
+def get_tax_jurisdictions(zips):
+	'''
+	The serialized jurisdictions of a list of ZIPs, keyed by the ZIPs as given (None if unknown)
+	'''
+	table = get_table()
+	return { str(zip): table.get(zip) for zip in zips }
+
+def get_tax_rate(zip):
+	'''
+	The estimated combined rate of the ZIP, or None if it is unknown
+	'''
+	return get_table().combined_rate(zip)
@@ -1,3 +1,5 @@
+import os, tempfile
+
 def make_ngrams(word, min_size=2, prefix_only=False):
 	length = len(word)
 	size_range = range(min_size, max(length, min_size) + 1)
@@ -10,4 +12,22 @@ def make_ngrams(word, min_size=2, prefix_only=False):
 		word[i:i + size]
 		for size in size_range
 		for i in range(0, max(0, length - size) + 1)
-	))
\ No newline at end of file
+	))
+
+# Read once at import, os.umask can only be read by setting it
+_umask = os.umask(0)
+os.umask(_umask)
+
+def write_atomic(path, write):
+	# A unique temporary file next to the target, so concurrent writers never share it
+	fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			# mkstemp creates the file 0600, give it the mode open() would have (the workers may
+			# run as another user than the CLI)
+			os.fchmod(f.fileno(), 0o666 & ~_umask)
+			write(f)
+		os.replace(tmpPath, path)
+	except BaseException:
+		os.remove(tmpPath)
+		raise
@@ -0,0 +1,8 @@
+'''
+Tasks for the in-memory search engine
+'''
+
+def saveSearchSnapshot():
+	# Imported here, tasks are loaded before the app is created
+	from services.search_service import save_snapshot
+	save_snapshot()
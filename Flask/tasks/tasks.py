@@ -2,7 +2,8 @@
 Asynchronous Tasks
 '''
 from .order import removeExpiredOrders
+from .search import saveSearchSnapshot
 
 def initialize_tasks(scheduler):
 	#scheduler.add_job(id='Remove Expired Orders', func=removeExpiredOrders, trigger='interval', seconds=5)
-	pass
\ No newline at end of file
+	scheduler.add_job(id='Save Search Snapshot', func=saveSearchSnapshot, trigger='interval', minutes=15)
\ No newline at end of file